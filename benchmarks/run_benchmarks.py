@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+###
+# Author: Bin Wang
+# -----
+# Copyright (c) 2022 National University of Singapore
+# -----
+# Offline CPU benchmarks of FacEval scoring (fac_gen_src/main.py) and of the
+# augmentation operators (src_model_fact_aug), on a tiny random BART and a
+# synthetic SAMSum-style corpus. Results are written as JSON that can be
+# compared across commits:
+#
+#   python benchmarks/run_benchmarks.py --output bench_new.json --compare bench_old.json
+
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+import statistics
+
+import torch
+import transformers
+from transformers import AutoTokenizer, BartConfig, BartForConditionalGeneration
+
+from synthetic_corpus import make_corpus
+
+
+REPO_DIR       = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FORMAT_VERSION = 'faceval-benchmark/1'
+
+
+def parse_args():
+    '''
+        config arguments for the benchmarks
+    '''
+    parser = argparse.ArgumentParser(description="Benchmark FacEval scoring and augmentation throughput")
+
+    parser.add_argument("--output", type=str, default='./benchmark_results.json', help="Where to write the results (json).")
+    parser.add_argument("--compare", type=str, default=None, help="Results of an earlier run to compare with.")
+    parser.add_argument("--work_dir", type=str, default='./output/benchmarks', help="Tiny model, corpora and run outputs.")
+    parser.add_argument("--suites", type=str, default='scoring,augmentation', help="Comma-separated suites to run.")
+    parser.add_argument("--tokenizer", type=str, default=os.path.join(REPO_DIR, 'trained_model'), help="Tokenizer of the repo model.")
+    parser.add_argument("--num_dialogues", type=int, default=32, help="Dialogues of every synthetic corpus.")
+    parser.add_argument("--batch_sizes", type=str, default='1,8,32', help="Scoring batch sizes.")
+    parser.add_argument("--dialogue_turns", type=str, default='6,12,24', help="Dialogue lengths (turns).")
+    parser.add_argument("--num_candidates", type=str, default='2,8,16', help="Summaries (1 pos + negatives) per dialogue.")
+    parser.add_argument("--modes", type=str, default='pointwise,grouped', help="Scoring modes: pointwise, grouped (--reuse_encoder).")
+    parser.add_argument("--num_threads", type=int, default=1, help="torch CPU threads of every scoring run.")
+    parser.add_argument("--num_passes", type=int, default=3, help="Augmentation passes of every operator.")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs per case, the median is reported.")
+    parser.add_argument("--warmup_batches", type=int, default=2, help="Untimed warm-up batches of every scoring run.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the tiny model and of the corpora.")
+
+    args = parser.parse_args()
+    for name in ('batch_sizes', 'dialogue_turns', 'num_candidates'):
+        setattr(args, name, [int(value) for value in getattr(args, name).split(',')])
+    args.modes  = args.modes.split(',')
+    args.suites = args.suites.split(',')
+
+    return args
+
+
+def environment():
+    ''' what the numbers depend on besides the code '''
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit'      : commit,
+        'python'      : platform.python_version(),
+        'torch'       : torch.__version__,
+        'transformers': transformers.__version__,
+        'machine'     : platform.machine(),
+        'processor'   : platform.processor(),
+        'cpu_count'   : os.cpu_count(),
+    }
+
+
+def write_jsonl(path, samples):
+    with open(path, 'w') as f:
+        for sample in samples:
+            f.write(json.dumps(sample) + '\n')
+
+
+# = = = = = = = = = = = = = = = = = = = = = Scoring = = = = = = = = = = = = = = = = = = = = = = =
+def make_tiny_model(args):
+    ''' randomly initialised (seeded) 2+2 layer BART with the repo tokenizer '''
+
+    model_dir = os.path.join(args.work_dir, 'tiny_bart')
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+
+    torch.manual_seed(args.seed)
+    config = BartConfig(
+        vocab_size              = len(tokenizer),
+        d_model                 = 64,
+        encoder_layers          = 2,
+        decoder_layers          = 2,
+        encoder_attention_heads = 4,
+        decoder_attention_heads = 4,
+        encoder_ffn_dim         = 128,
+        decoder_ffn_dim         = 128,
+        max_position_embeddings = 1024,
+        pad_token_id            = tokenizer.pad_token_id,
+        bos_token_id            = tokenizer.bos_token_id,
+        eos_token_id            = tokenizer.eos_token_id,
+        decoder_start_token_id  = tokenizer.eos_token_id,
+    )
+    BartForConditionalGeneration(config).save_pretrained(model_dir)
+    tokenizer.save_pretrained(model_dir)
+
+    return model_dir
+
+
+def scoring_cases(args):
+    ''' one axis varied at a time around the middle value of the others '''
+
+    default = {'batch_size'    : args.batch_sizes[len(args.batch_sizes) // 2],
+               'turns'         : args.dialogue_turns[len(args.dialogue_turns) // 2],
+               'num_candidates': args.num_candidates[len(args.num_candidates) // 2]}
+    axes    = (('batch_size', args.batch_sizes), ('turns', args.dialogue_turns), ('num_candidates', args.num_candidates))
+
+    cases = []
+    for mode in args.modes:
+        for name, values in axes:
+            for value in values:
+                case = dict(default, mode=mode, **{name: value})
+                if case not in cases:
+                    cases.append(case)
+
+    return cases
+
+
+def case_key(case):
+    return '/'.join("{}={}".format(name, case[name]) for name in sorted(case))
+
+
+def run_scoring_case(args, model_dir, case):
+    ''' score a synthetic corpus with main.py --profile, `repeats` times (after untimed warm-up batches) '''
+
+    corpus_file = os.path.join(args.work_dir, 'corpus_t{}_c{}.jsonl'.format(case['turns'], case['num_candidates']))
+    if not os.path.exists(corpus_file):
+        write_jsonl(corpus_file, make_corpus(args.num_dialogues, case['turns'], case['num_candidates'], args.seed))
+
+    output_dir = os.path.join(args.work_dir, 'run')
+    command = [
+        sys.executable, os.path.join(REPO_DIR, 'fac_gen_src', 'main.py'),
+        '--neg_marker', 'all',
+        '--output_dir', output_dir,
+        '--load_file', corpus_file,
+        '--text_column', 'dialogue',
+        '--summary_column', 'summary',
+        '--model_name_or_path', model_dir,
+        '--model_type', 'bart',
+        '--per_device_test_batch_size', str(case['batch_size']),
+        '--num_threads', str(args.num_threads),
+        '--num_bootstrap', '0',
+        '--overwrite_cache', 'True',
+        '--seed', str(args.seed),
+        '--profile',
+        '--profile_warmup', str(args.warmup_batches),
+    ] + (['--reuse_encoder'] if case['mode'] == 'grouped' else [])
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+
+    runs = []
+    for _ in range(args.repeats):
+        start = time.time()
+        process = subprocess.run(command, env=env, cwd=args.work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            raise RuntimeError("Scoring run {} failed:\n{}".format(case_key(case), process.stderr.decode()[-2000:]))
+        with open(os.path.join(output_dir, 'profile.json')) as f:
+            profile = json.load(f)
+        runs.append({
+            'process_seconds': time.time() - start,
+            'score_seconds'  : profile['stages']['score']['seconds'],
+            'samples_per_sec': profile['throughput']['samples_per_sec'],
+            'tokens_per_sec' : profile['throughput']['tokens_per_sec'],
+            'padding_ratio'  : profile['throughput']['padding_ratio'],
+            'peak_rss_mb'    : profile['peak_rss_mb'],
+            'stages'         : {name: stage['seconds'] for name, stage in profile['stages'].items()},
+        })
+
+    return summarize_runs(runs, case)
+
+
+def summarize_runs(runs, params):
+    ''' median of every metric over the repeats, plus the raw samples_per_sec '''
+
+    summary = {'params': params, 'repeats': len(runs), 'runs_samples_per_sec': [run['samples_per_sec'] for run in runs]}
+    for metric in ('process_seconds', 'score_seconds', 'samples_per_sec', 'tokens_per_sec', 'padding_ratio', 'peak_rss_mb'):
+        summary[metric] = statistics.median(run[metric] for run in runs)
+    summary['stages'] = {name: statistics.median(run['stages'].get(name, 0.0) for run in runs)
+                         for name in sorted(set(name for run in runs for name in run['stages']))}
+
+    return summary
+
+
+def scoring_suite(args):
+    model_dir = make_tiny_model(args)
+
+    results = {}
+    for case in scoring_cases(args):
+        print("scoring {}".format(case_key(case)), flush=True)
+        results[case_key(case)] = run_scoring_case(args, model_dir, case)
+
+    return results
+
+
+# = = = = = = = = = = = = = = = = = = = = = Augmentation = = = = = = = = = = = = = = = = = = = = = = =
+def augmentation_suite(args):
+    ''' spaCy parsing and per-operator corruption throughput (needs en_core_web_sm) '''
+
+    sys.path.insert(0, os.path.join(REPO_DIR, 'src_model_fact_aug'))
+    import augmentation_ops as ops
+
+    try:
+        ops.load_spacy()
+    except OSError as error:
+        return {'skipped': str(error)}
+
+    turns   = args.dialogue_turns[len(args.dialogue_turns) // 2]
+    samples = [{key: sample[key] for key in ('id', 'dialogue', 'summary')}
+               for sample in make_corpus(args.num_dialogues * 4, turns, 1, args.seed)]
+
+    results = {}
+
+    start    = time.perf_counter()
+    analyses = ops.analyse_samples(samples)
+    seconds  = time.perf_counter() - start
+    results['parse'] = {'params': {'samples': len(samples), 'turns': turns}, 'seconds': seconds,
+                        'samples_per_sec': len(samples) / seconds}
+
+    for label in sorted(ops.OPERATORS):
+        operator = ops.get_operator(label)
+        runs     = []
+        for _ in range(args.repeats):
+            random.seed("{}-{}".format(args.seed, label))
+            produced, start = 0, time.perf_counter()
+            for _ in range(args.num_passes):
+                for sample, analysis in zip(samples, analyses):
+                    new_sample, _ = operator.transform(sample.copy(), analysis)
+                    produced += new_sample is not None
+            candidates = sum(len(operator.candidates(sample, analysis)) for sample, analysis in zip(samples, analyses))
+            runs.append({'seconds': time.perf_counter() - start, 'produced': produced, 'candidates': candidates})
+
+        seconds = statistics.median(run['seconds'] for run in runs)
+        results[label] = {
+            'params'         : {'samples': len(samples), 'passes': args.num_passes, 'turns': turns},
+            'repeats'        : len(runs),
+            'seconds'        : seconds,
+            'samples_per_sec': len(samples) * args.num_passes / seconds,
+            'produced'       : runs[0]['produced'],
+            'candidates'     : runs[0]['candidates'],
+        }
+
+    return results
+
+
+# = = = = = = = = = = = = = = = = = = = = = Report = = = = = = = = = = = = = = = = = = = = = = =
+def compare(old, new):
+    ''' samples_per_sec of every case present in both result files '''
+
+    lines = ["{:<70} {:>12} {:>12} {:>8}".format('case', 'old /s', 'new /s', 'ratio')]
+    for suite in ('scoring', 'augmentation'):
+        for key in sorted(set(old.get(suite, {})) & set(new.get(suite, {}))):
+            old_rate = old[suite][key].get('samples_per_sec')
+            new_rate = new[suite][key].get('samples_per_sec')
+            if old_rate and new_rate:
+                lines.append("{:<70} {:>12.2f} {:>12.2f} {:>8.3f}".format(suite + ':' + key, old_rate, new_rate, new_rate / old_rate))
+
+    return '\n'.join(lines)
+
+
+def main():
+    args = parse_args()
+    args.work_dir = os.path.abspath(args.work_dir)
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    results = {
+        'format'     : FORMAT_VERSION,
+        'environment': environment(),
+        'settings'   : {name: value for name, value in vars(args).items() if name not in ('output', 'compare', 'work_dir')},
+    }
+    if 'scoring' in args.suites:
+        results['scoring'] = scoring_suite(args)
+    if 'augmentation' in args.suites:
+        results['augmentation'] = augmentation_suite(args)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("results written to {}".format(args.output))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            print(compare(json.load(f), results))
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# Main Process
+if __name__ == "__main__":
+    main()
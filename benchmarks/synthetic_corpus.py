@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+###
+# Author: Bin Wang
+# -----
+# Copyright (c) 2022 National University of Singapore
+# -----
+
+
+import random
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# SAMSum-style building blocks: speakers, places, days, numbers and small talk,
+# so that every augmentation operator finds something to corrupt
+SPEAKERS = ['Hannah', 'Amanda', 'Larry', 'Eric', 'Rob', 'Lenny', 'Bob', 'Emma', 'Jane', 'Tom', 'Kate', 'Mark']
+PLACES   = ['the park', 'the cinema', 'Starbucks', 'the office', 'London', 'the gym', 'Paris', 'the station']
+DAYS     = ['Monday', 'Tuesday', 'Friday', 'Saturday', 'tomorrow', 'next week', 'June 5th', 'tonight']
+ITEMS    = ['tickets', 'pizzas', 'books', 'chairs', 'bottles of wine', 'cakes']
+NUMBERS  = ['two', 'three', 'four', '5', '10', '12']
+
+SMALL_TALK = [
+    "How are you doing?",
+    "I'm fine, thanks. Busy week though.",
+    "Did you see the game yesterday?",
+    "Not really, I was working late.",
+    "She told me he is coming too.",
+    "I don't think they will like it.",
+    "Can you call me when you are free?",
+    "Sure, I will text you later.",
+    "We should ask her about it.",
+    "That sounds great, let's do it!",
+]
+
+
+def make_dialogue(rng, sample_id, num_turns):
+    ''' one dialogue with a plan (who meets where / when, what they bring) and its faithful summary '''
+
+    first, second = rng.sample(SPEAKERS, 2)
+    place, day    = rng.choice(PLACES), rng.choice(DAYS)
+    number, item  = rng.choice(NUMBERS), rng.choice(ITEMS)
+
+    turns = [
+        "{}: Do you want to meet at {} {}?".format(first, place, day),
+        "{}: Sure, I will bring {} {}.".format(second, number, item),
+    ]
+    while len(turns) < num_turns - 1:
+        turns.append("{}: {}".format((first, second)[len(turns) % 2], rng.choice(SMALL_TALK)))
+    turns.append("{}: Great, see you {}!".format(first, day))
+
+    return {
+        'id'      : str(sample_id),
+        'dialogue': '\n'.join(turns[:max(num_turns, 2)]),
+        'summary' : "{} and {} will meet at {} {}. {} will bring {} {}.".format(first, second, place, day, second, number, item),
+    }
+
+
+def corrupt(rng, sample, index):
+    ''' a (label, summary) negative of the sample, cycling through speaker / number / date / entity / negation errors '''
+
+    summary  = sample['summary']
+    speakers = sorted(set(line.split(':')[0] for line in sample['dialogue'].split('\n')))
+    kind     = index % 5
+
+    if kind == 0:
+        first, second = speakers[0], speakers[-1]
+        return 'ss_neg', summary.replace(first, '<tmp>').replace(second, first).replace('<tmp>', second)
+    if kind == 1:
+        number = next(number for number in NUMBERS if ' {} '.format(number) in summary)
+        return 'ns_neg', summary.replace(' {} '.format(number), ' {} '.format(rng.choice([n for n in NUMBERS if n != number])))
+    if kind == 2:
+        day = next(day for day in DAYS if day in summary)
+        return 'ds_neg', summary.replace(day, rng.choice([d for d in DAYS if d != day]))
+    if kind == 3:
+        place = next(place for place in PLACES if place in summary)
+        return 'es_neg', summary.replace(place, rng.choice([p for p in PLACES if p != place]))
+    return 'ng_neg', summary.replace(' will ', ' will not ', 1 + index // 5 % 2)
+
+
+def make_corpus(num_dialogues, num_turns, num_candidates, seed=0):
+    ''' FacEval-style samples: for every dialogue one 'pos' summary and num_candidates - 1 negatives '''
+
+    rng     = random.Random("{}-{}-{}".format(seed, num_turns, num_candidates))
+    samples = []
+    for sample_id in range(num_dialogues):
+        sample = make_dialogue(rng, sample_id, num_turns)
+        samples.append(dict(sample, label='pos'))
+        for index in range(num_candidates - 1):
+            label, summary = corrupt(rng, sample, index)
+            samples.append(dict(sample, summary=summary, label=label))
+
+    return samples
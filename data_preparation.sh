@@ -7,7 +7,10 @@ start=`date +%s`
 echo "= = = = = = = = = = = = = ="
 
 
-python src_model_fact_aug/create_eval.py
+python src_model_fact_aug/create_eval.py \
+    --spacy_n_process 10 \
+    --spacy_batch_size 64 \
+    --chunk_size 2000
 
 
 echo "= = = = = = = = = = = = = ="
@@ -8,8 +8,9 @@ echo "= = = = = = = = = = = = = ="
 
 
 
+# score all error types (_neg, ss_neg, es_neg, ps_neg, ds_neg, ns_neg, ng_neg) with a single model load
 python fac_gen_src/main.py \
-    --neg_marker _neg \
+    --neg_marker all \
     --output_dir ./scores_log/ \
     --load_file ./data/faceval_samples.json \
     --text_column dialogue \
@@ -19,113 +20,24 @@ python fac_gen_src/main.py \
     --max_source_length 1024 \
     --min_target_length 1 \
     --max_target_length 128 \
+    --reuse_encoder \
     --length_penalty 1.0 \
     --cache_dir ./output/cache \
     --overwrite_cache True \
+    --token_store_dir ./output/token_store \
     --seed 12345
 
-
-python fac_gen_src/main.py \
-    --neg_marker ss_neg \
-    --output_dir ./scores_log/ \
-    --load_file ./data/faceval_samples.json \
-    --text_column dialogue \
-    --summary_column summary \
-    --model_name_or_path ./trained_model/ \
-    --model_type bart \
-    --max_source_length 1024 \
-    --min_target_length 1 \
-    --max_target_length 128 \
-    --length_penalty 1.0 \
-    --cache_dir ./output/cache \
-    --overwrite_cache True \
-    --seed 12345
-
-python fac_gen_src/main.py \
-    --neg_marker es_neg \
-    --output_dir ./scores_log/ \
-    --load_file ./data/faceval_samples.json \
-    --text_column dialogue \
-    --summary_column summary \
-    --model_name_or_path ./trained_model/ \
-    --model_type bart \
-    --max_source_length 1024 \
-    --min_target_length 1 \
-    --max_target_length 128 \
-    --length_penalty 1.0 \
-    --cache_dir ./output/cache \
-    --overwrite_cache True \
-    --seed 12345
-
-
-python fac_gen_src/main.py \
-    --neg_marker ps_neg \
-    --output_dir ./scores_log/ \
-    --load_file ./data/faceval_samples.json \
-    --text_column dialogue \
-    --summary_column summary \
-    --model_name_or_path ./trained_model/ \
-    --model_type bart \
-    --max_source_length 1024 \
-    --min_target_length 1 \
-    --max_target_length 128 \
-    --length_penalty 1.0 \
-    --cache_dir ./output/cache \
-    --overwrite_cache True \
-    --seed 12345
-
-
-
-python fac_gen_src/main.py \
-    --neg_marker ds_neg \
-    --output_dir ./scores_log/ \
-    --load_file ./data/faceval_samples.json \
-    --text_column dialogue \
-    --summary_column summary \
-    --model_name_or_path ./trained_model/ \
-    --model_type bart \
-    --max_source_length 1024 \
-    --min_target_length 1 \
-    --max_target_length 128 \
-    --length_penalty 1.0 \
-    --cache_dir ./output/cache \
-    --overwrite_cache True \
-    --seed 12345
-
-
-
-python fac_gen_src/main.py \
-    --neg_marker ns_neg \
-    --output_dir ./scores_log/ \
-    --load_file ./data/faceval_samples.json \
-    --text_column dialogue \
-    --summary_column summary \
-    --model_name_or_path ./trained_model/ \
-    --model_type bart \
-    --max_source_length 1024 \
-    --min_target_length 1 \
-    --max_target_length 128 \
-    --length_penalty 1.0 \
-    --cache_dir ./output/cache \
-    --overwrite_cache True \
-    --seed 12345
-
-
-python fac_gen_src/main.py \
-    --neg_marker ng_neg \
-    --output_dir ./scores_log/ \
-    --load_file ./data/faceval_samples.json \
-    --text_column dialogue \
-    --summary_column summary \
-    --model_name_or_path ./trained_model/ \
-    --model_type bart \
-    --max_source_length 1024 \
-    --min_target_length 1 \
-    --max_target_length 128 \
-    --length_penalty 1.0 \
-    --cache_dir ./output/cache \
-    --overwrite_cache True \
-    --seed 12345
+# CPU-only data-parallel scoring: every process scores the dialogues of one shard (by id),
+# writes ./scores_log/partials/ and the main process merges them, e.g.
+#   torchrun --nproc_per_node 8 fac_gen_src/main.py <same arguments>
+# or on several boxes sharing the filesystem, one shard each, then merge:
+#   python fac_gen_src/main.py <same arguments> --num_shards 4 --shard_id 0
+#   python fac_gen_src/main.py <same arguments> --num_shards 4 --merge_only
+
+# resident scoring server (model loaded once, localhost / Unix socket only), e.g. for a training loop:
+#   python fac_gen_src/server.py --model_name_or_path ./trained_model/ --model_type bart --socket_path /tmp/faceval.sock
+#   curl --unix-socket /tmp/faceval.sock http://localhost/score \
+#        -d '{"samples": [{"dialogue": "...", "summaries": ["...", "..."], "reference": 0}]}'
 
 
 echo "= = = = = = = = = = = = = ="
@@ -7,6 +7,7 @@
 # -----
 
 
+import os
 import argparse
 
 from transformers import (
@@ -14,14 +15,19 @@ from transformers import (
     SchedulerType,
 )
 
+from precision import PRECISIONS
+
 # You should update this to your particular problem to have better documentation of `model_type`
 MODEL_CONFIG_CLASSES = list(MODEL_MAPPING.keys())
 MODEL_TYPES = tuple(conf.model_type for conf in MODEL_CONFIG_CLASSES)
 
+# Error types of negative samples in FacEval ('_neg' covers all of them)
+NEG_MARKERS = ['_neg', 'ss_neg', 'es_neg', 'ps_neg', 'ds_neg', 'ns_neg', 'ng_neg']
+
 
-def parse_args():
+def parse_args(require_neg_marker=True):
     '''
-        config arguments for training
+        config arguments for training (the scoring server does not need --neg_marker)
     '''
     parser = argparse.ArgumentParser(description="Finetune a transformers model on a summarization task")
 
@@ -30,7 +36,10 @@ def parse_args():
     )
 
     parser.add_argument(
-        "--neg_marker", type=str, default=None, help="A csv or a json file containing the training data."
+        "--neg_marker",
+        type=str,
+        default=None,
+        help="Error type(s) of negative samples to score, comma separated (e.g. 'ss_neg,es_neg'), or 'all'.",
     )
 
     parser.add_argument(
@@ -144,7 +153,12 @@ def parse_args():
         "--per_device_test_batch_size",
         type=int,
         default=8,
-        help="Batch size (per device) for the evaluation dataloader.",
+        help="Batch size (per device) for scoring positive / negative summaries.",
+    )
+    parser.add_argument(
+        "--reuse_encoder",
+        action="store_true",
+        help="If passed, encode each dialogue once and score all of its candidate summaries against the cached encoder output.",
     )
     parser.add_argument(
         "--learning_rate",
@@ -178,6 +192,165 @@ def parse_args():
     )
     parser.add_argument("--output_dir", type=str, default=None, help="Where to store the final model.")
     parser.add_argument("--cache_dir", type=str, default=None, help="Cache directory for pre-trained models.")
+    parser.add_argument(
+        "--tie_policy",
+        type=str,
+        default="strict",
+        choices=["strict", "half"],
+        help="How a (pos, neg) pair with equal scores counts: 'strict' as a miss, 'half' as half a hit.",
+    )
+    parser.add_argument(
+        "--num_bootstrap",
+        type=int,
+        default=1000,
+        help="Number of bootstrap resamples (over dialogues) for the confidence interval of each score.",
+    )
+    parser.add_argument(
+        "--score_cache_dir",
+        type=str,
+        default=None,
+        help="If passed, reuse per-sample log-probabilities cached here for the same model / tokenizer / lengths.",
+    )
+    parser.add_argument(
+        "--manifest_file",
+        type=str,
+        default=None,
+        help="Incremental evaluation: manifest of the previous run over the sample set (created if missing). "
+        "Only new / changed samples are scored and only the affected per-dialogue results recomputed.",
+    )
+    parser.add_argument(
+        "--dialogue_ids",
+        type=str,
+        default=None,
+        help="Only score these dialogues: comma-separated ids, or a file with one id per line.",
+    )
+    parser.add_argument(
+        "--sample_index_dir",
+        type=str,
+        default=None,
+        help="Where the label / id index of --load_file is kept. Defaults to the directory of the file.",
+    )
+    parser.add_argument(
+        "--save_safetensors",
+        action='store_true',
+        default=False,
+        help="Write model.safetensors next to the model weights, later runs then load it memory-mapped.",
+    )
+    parser.add_argument(
+        "--token_store_dir",
+        type=str,
+        default=None,
+        help="If passed, token ids are read from (and new texts added to) a persistent store here instead of "
+        "tokenizing the datasets on every run.",
+    )
+    parser.add_argument(
+        "--num_shards",
+        type=int,
+        default=None,
+        help="Split the samples (by dialogue id) into this many shards. Defaults to the number of accelerate processes.",
+    )
+    parser.add_argument(
+        "--shard_id",
+        type=int,
+        default=None,
+        help="Shard scored by this process. Defaults to the accelerate process index.",
+    )
+    parser.add_argument(
+        "--merge_only",
+        action='store_true',
+        default=False,
+        help="Do not score anything, only merge the partial results of all shards in output_dir.",
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=None,
+        help="Number of torch CPU threads per process. Defaults to the cores of the machine split over its processes.",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=PRECISIONS,
+        help="Scoring precision: fp32, dynamic int8 quantization of the Linear layers, or bf16 autocast.",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="torch",
+        choices=["torch", "onnx"],
+        help="Score with PyTorch, or with the model exported to ONNX and run on ONNX Runtime (CPU).",
+    )
+    parser.add_argument(
+        "--onnx_dir",
+        type=str,
+        default=None,
+        help="Where the ONNX graphs are exported to / loaded from. Defaults to output_dir/onnx.",
+    )
+    parser.add_argument(
+        "--onnx_parity_tol",
+        type=float,
+        default=1e-3,
+        help="Largest allowed |log-prob| difference between PyTorch and ONNX Runtime in the parity check.",
+    )
+    parser.add_argument(
+        "--agreement_first_dialogues",
+        type=int,
+        default=32,
+        help="With --precision int8 / bf16 (or a fresh ONNX export), the first N dialogues of the sample set are also "
+        "scored in fp32 (or PyTorch) and compared (precision_agreement.json / parity.json). They are not held out. "
+        "0 disables the check.",
+    )
+    parser.add_argument(
+        "--profile",
+        action='store_true',
+        default=False,
+        help="Time the scoring stages (tokenize, collate, encoder, decoder, log-softmax, transfers), count samples / "
+        "tokens / padding and write output_dir/profile.json.",
+    )
+    parser.add_argument(
+        "--profile_torch",
+        action='store_true',
+        default=False,
+        help="Also run the scoring under torch.profiler (implies --profile): a chrome trace and the top operators.",
+    )
+    parser.add_argument(
+        "--profile_warmup",
+        type=int,
+        default=0,
+        help="With --profile, score the first N batches once before the timed run (stage 'warmup'), so one-time setup "
+        "of the first forward passes is not counted in the scoring stages.",
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="Scoring server: loopback address to listen on.",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="Scoring server: TCP port to listen on.",
+    )
+    parser.add_argument(
+        "--socket_path",
+        type=str,
+        default=None,
+        help="Scoring server: listen on this Unix socket instead of host:port.",
+    )
+    parser.add_argument(
+        "--max_batch_candidates",
+        type=int,
+        default=64,
+        help="Scoring server: requests waiting together are merged into one micro-batch of up to this many summaries.",
+    )
+    parser.add_argument(
+        "--max_batch_wait_ms",
+        type=float,
+        default=10.0,
+        help="Scoring server: how long the first request of a micro-batch waits for others to join it.",
+    )
     parser.add_argument("--seed", type=int, default=None, help="A seed for reproducible training.")
     parser.add_argument(
         "--model_type",
@@ -256,5 +429,24 @@ def parse_args():
             "You're running a t5 model but didn't provide a source prefix, which is the expected, e.g. with "
             "`--source_prefix 'summarize: ' `"
         )
-    
+
+    if args.dialogue_ids is not None:
+        if os.path.isfile(args.dialogue_ids):
+            with open(args.dialogue_ids) as f:
+                args.dialogue_ids = [line.strip() for line in f if line.strip()]
+        else:
+            args.dialogue_ids = [sample_id.strip() for sample_id in args.dialogue_ids.split(',') if sample_id.strip()]
+
+    if args.backend == 'onnx' and args.precision != 'fp32':
+        raise ValueError("`--precision {}` is only supported by the torch backend".format(args.precision))
+
+    if args.neg_marker is None:
+        if require_neg_marker:
+            raise ValueError("Make sure that `--neg_marker` is defined")
+        args.neg_markers = []
+    elif args.neg_marker == 'all':
+        args.neg_markers = list(NEG_MARKERS)
+    else:
+        args.neg_markers = [marker.strip() for marker in args.neg_marker.split(',') if marker.strip()]
+
     return args
\ No newline at end of file
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+###
+# Author: Bin Wang
+# -----
+# Copyright (c) 2022 National University of Singapore
+# -----
+# Columnar FacEval sample sets: a directory with two Arrow IPC files,
+#   dialogues.arrow  : id, dialogue                     (one row per distinct dialogue)
+#   candidates.arrow : id, dialogue_row, summary, label (one row per summary, grouped by label)
+# Convert an existing json / jsonl sample file with
+#   python fac_gen_src/columnar.py --input data/faceval_samples.json --output_dir data/faceval_samples.arrow
+
+
+import os
+import argparse
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from sample_index import is_json_array, iter_json_array_rows, iter_jsonl_rows
+
+FORMAT_VERSION  = 'faceval-columnar/1'
+DIALOGUES_FILE  = 'dialogues.arrow'
+CANDIDATES_FILE = 'candidates.arrow'
+
+
+def is_columnar(path):
+    return os.path.isfile(os.path.join(path, CANDIDATES_FILE)) and os.path.isfile(os.path.join(path, DIALOGUES_FILE))
+
+
+def write_table(table, path):
+    ''' uncompressed Arrow IPC file (tmp file + rename), so that readers can memory-map it '''
+
+    table = table.replace_schema_metadata({'format': FORMAT_VERSION})
+    with pa.OSFile(path + '.tmp', 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(path + '.tmp', path)
+
+
+def write_columnar(samples, output_dir):
+    ''' write an iterable of {'id', 'dialogue', 'summary', 'label'} samples as a columnar sample set
+
+        Every distinct (id, dialogue) is stored once. The candidates are stably grouped by label,
+        so the rows of an error type form one contiguous (zero-copy) slice.
+    '''
+
+    dialogue_rows = {}
+    columns = {'id': [], 'dialogue_row': [], 'summary': [], 'label': []}
+    for sample in samples:
+        key = (str(sample['id']), sample['dialogue'])
+        columns['id'].append(key[0])
+        columns['dialogue_row'].append(dialogue_rows.setdefault(key, len(dialogue_rows)))
+        columns['summary'].append(sample['summary'])
+        columns['label'].append(sample['label'])
+
+    order      = np.argsort(np.asarray(columns['label'], dtype=str), kind='stable')
+    candidates = pa.table({
+        'id'          : pa.array(columns['id'], pa.string()),
+        'dialogue_row': pa.array(columns['dialogue_row'], pa.int32()),
+        'summary'     : pa.array(columns['summary'], pa.string()),
+        'label'       : pa.array(columns['label'], pa.string()),
+    }).take(pa.array(order))
+    dialogues  = pa.table({
+        'id'      : pa.array([sample_id for sample_id, _ in dialogue_rows], pa.string()),
+        'dialogue': pa.array([dialogue for _, dialogue in dialogue_rows], pa.string()),
+    })
+
+    os.makedirs(output_dir, exist_ok=True)
+    write_table(dialogues, os.path.join(output_dir, DIALOGUES_FILE))
+    write_table(candidates, os.path.join(output_dir, CANDIDATES_FILE))
+
+
+def read_table(path):
+    ''' memory-mapped Arrow IPC file, the table references the mapped pages instead of copying them '''
+
+    return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+
+class ColumnarSamples():
+    # A columnar sample set opened with memory mapping
+
+    def __init__(self, path):
+        self.dialogues  = read_table(os.path.join(path, DIALOGUES_FILE))
+        self.candidates = read_table(os.path.join(path, CANDIDATES_FILE))
+
+        # contiguous [start, end) rows of every label (the candidates are grouped by label)
+        counts      = self.candidates['label'].value_counts()
+        ends        = np.cumsum(counts.field('counts').to_numpy())
+        self.ranges = {label: (int(end - count), int(end))
+                       for label, count, end in zip(counts.field('values').to_pylist(), counts.field('counts').to_pylist(), ends)}
+
+    @property
+    def labels(self):
+        return sorted(self.ranges)
+
+    def select(self, labels, dialogue_ids=None):
+        ''' (id, dialogue_row, summary, marker) table of the candidates with one of the labels
+
+            The label slices are zero-copy views of the mapped file. The dialogue text is not
+            expanded per candidate, dialogue_row is its row in self.dialogues.
+        '''
+
+        slices = [self.candidates.slice(start, end - start) for start, end in
+                  sorted(self.ranges[label] for label in dict.fromkeys(labels) if label in self.ranges)]
+        table  = pa.concat_tables(slices) if slices else self.candidates.slice(0, 0)
+        if dialogue_ids is not None:
+            table = table.filter(pc.is_in(table['id'], value_set=pa.array([str(sample_id) for sample_id in dialogue_ids])))
+
+        return pa.table({
+            'id'          : table['id'],
+            'dialogue_row': table['dialogue_row'],
+            'summary'     : table['summary'],
+            'marker'      : table['label'],
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a FacEval json / jsonl sample file to the columnar format")
+    parser.add_argument("--input", type=str, required=True, help="json array or jsonl sample file.")
+    parser.add_argument("--output_dir", type=str, required=True, help="Directory of the columnar sample set.")
+    args = parser.parse_args()
+
+    rows = iter_json_array_rows(args.input) if is_json_array(args.input) else iter_jsonl_rows(args.input)
+    write_columnar((sample for _, _, sample in rows), args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,83 +7,126 @@
 # -----
 
 
-import json
 import random
 import logging
 
+import numpy as np
 import datasets
 from datasets import Dataset
 from torch.utils.data import DataLoader
 
 from transformers import DataCollatorForSeq2Seq
 
+from args import NEG_MARKERS
+from token_store import TokenStore
+from sample_index import SampleIndex
+from columnar import ColumnarSamples, is_columnar
+from metrics import POS_LABEL, marker_labels
+
+
+class SampleDatasets(datasets.DatasetDict):
+    # The pos / neg samples (id, dialogue_row, summary, marker). Every row references its dialogue
+    # in the list of distinct dialogues, so a dialogue shared by all its candidates is stored and
+    # tokenized once.
+
+    def __init__(self, splits, dialogues):
+        super().__init__(splits)
+        self.dialogues = dialogues
+
+    def select_rows(self, rows):
+        ''' {split: rows} of every split, referencing the same dialogues '''
+
+        return SampleDatasets({split: self[split].select(rows[split]) for split in self}, self.dialogues)
+
+    def dialogue_texts(self, split):
+        ''' the dialogue of every row of a split (one shared str per dialogue) '''
+
+        return [self.dialogues[row] for row in self[split]['dialogue_row']]
+
 
 def raw_data_loader(args):
     ''' load raw datasets '''
 
     logging.info("Loading data from SAMSum dataset")
-    pos_data_dict, neg_data_dict = load_from_samsum(args, args.load_file)
+    pos_data_dict, neg_data_dict, dialogues = load_from_samsum(args, args.load_file)
 
-    raw_datasets = datasets.DatasetDict({"pos_data_dict": pos_data_dict, "neg_data_dict": neg_data_dict})
+    raw_datasets = SampleDatasets({"pos_data_dict": pos_data_dict, "neg_data_dict": neg_data_dict}, dialogues)
     logging.info("# of Pos: {}. # of Neg: {}.".format(len(raw_datasets['pos_data_dict']), len(raw_datasets['neg_data_dict'])))
 
     return raw_datasets
 
 
 def load_from_samsum(args, file_path):
-    ''' load samsum jsonl data '''
+    ''' load FacEval samples (jsonl or json array), keeping only positives and the requested negatives
 
-    pos_id_list       = []
-    pos_dialogue_list = []
-    pos_summary_list  = []
-    pos_marker_list   = []
+        Returns the pos / neg datasets and the distinct dialogues their dialogue_row refers to.
 
-    neg_id_list       = []
-    neg_dialogue_list = []
-    neg_summary_list  = []
-    neg_marker_list   = []
+        Rows are looked up in the persisted label / id index of the file, so only the selected
+        error types (exact labels, '_neg' for all of them) and dialogues are read.
+    '''
 
-    with open(file_path, 'r') as f:
-        samples = json.load(f)
+    if is_columnar(file_path):
+        return load_from_columnar(args, file_path)
 
-    for sample in samples:
+    index      = SampleIndex.load(file_path, args.sample_index_dir)
+    neg_labels = selected_labels(args.neg_markers, index.labels, file_path)
 
-        if sample['label'] == 'pos':
-            pos_id_list.append(sample['id'])
-            pos_dialogue_list.append(sample['dialogue'])
-            pos_summary_list.append(sample['summary'])
-            pos_marker_list.append(sample['label'])
+    pos_samples = index.read(index.rows(labels=[POS_LABEL], dialogue_ids=args.dialogue_ids))
+    neg_samples = index.read(index.rows(labels=neg_labels, dialogue_ids=args.dialogue_ids))
 
-        elif args.neg_marker in sample['label']:
-            neg_id_list.append(sample['id'])
-            neg_dialogue_list.append(sample['dialogue'])
-            neg_summary_list.append(sample['summary'])
-            neg_marker_list.append(sample['label'])
+    # every distinct (id, dialogue) once
+    dialogue_rows = {}
+    for sample in pos_samples + neg_samples:
+        dialogue_rows.setdefault((sample['id'], sample['dialogue']), len(dialogue_rows))
 
     pos_data_dict = {
-                    'id'      : pos_id_list,
-                    'dialogue': pos_dialogue_list,
-                    'summary' : pos_summary_list,
-                    'marker'  : pos_marker_list
+                    'id'          : [sample['id'] for sample in pos_samples],
+                    'dialogue_row': [dialogue_rows[(sample['id'], sample['dialogue'])] for sample in pos_samples],
+                    'summary'     : [sample['summary'] for sample in pos_samples],
+                    'marker'      : [sample['label'] for sample in pos_samples]
                     }
 
     neg_data_dict = {
-                    'id'      : neg_id_list,
-                    'dialogue': neg_dialogue_list,
-                    'summary' : neg_summary_list,
-                    'marker'  : neg_marker_list
+                    'id'          : [sample['id'] for sample in neg_samples],
+                    'dialogue_row': [dialogue_rows[(sample['id'], sample['dialogue'])] for sample in neg_samples],
+                    'summary'     : [sample['summary'] for sample in neg_samples],
+                    'marker'      : [sample['label'] for sample in neg_samples]
                     }
 
     pos_data_dict = Dataset.from_dict(pos_data_dict)
     neg_data_dict = Dataset.from_dict(neg_data_dict)
 
-    return pos_data_dict, neg_data_dict
+    return pos_data_dict, neg_data_dict, [dialogue for _, dialogue in dialogue_rows]
+
+
+def load_from_columnar(args, path):
+    ''' same datasets from a columnar sample set (see columnar.py), the candidates are backed by its memory-mapped table '''
+
+    samples    = ColumnarSamples(path)
+    neg_labels = selected_labels(args.neg_markers, samples.labels, path)
+
+    pos_data_dict = Dataset(samples.select([POS_LABEL], args.dialogue_ids))
+    neg_data_dict = Dataset(samples.select(neg_labels, args.dialogue_ids))
+
+    return pos_data_dict, neg_data_dict, samples.dialogues['dialogue'].to_pylist()
+
+
+def selected_labels(neg_markers, labels, file_path):
+    ''' negative labels selected by the error type markers (exact labels, '_neg' for all of them) '''
+
+    neg_labels = []
+    for marker in neg_markers:
+        if marker not in NEG_MARKERS and marker not in labels:
+            raise ValueError("Unknown error type `{}`, {} has the labels {}".format(marker, file_path, labels))
+        neg_labels.extend(label for label in marker_labels(marker, labels) if label not in neg_labels)
+
+    return neg_labels
 
 
 def data_processor(logger, args, accelerator, raw_datasets, tokenizer, model):
     ''' prepare dataset format for train / val / test '''
 
-    def preprocess_function(examples):
+    def preprocess_function(examples, indices):
 
         # summary - target
         targets = examples[summary_column]
@@ -94,23 +137,17 @@ def data_processor(logger, args, accelerator, raw_datasets, tokenizer, model):
             with tokenizer.as_target_tokenizer():
                 neg_summary = tokenizer(examples['neg_summary'], max_length=max_target_length, padding=padding, truncation=True)
 
-        # dialogue - input
-        inputs = examples[text_column]
-        new_inputs = []
-        for i, inp in enumerate(inputs):
-            new_inputs.append(prefix + inp)
-
-        inputs       = new_inputs
-        model_inputs = tokenizer(inputs, max_length=args.max_source_length, padding=padding, truncation=True)
+        # dialogue - input, tokenized once per dialogue (see below)
+        model_inputs = {key: [values[source_rows[row]] for row in examples['dialogue_row']] for key, values in sources.items()}
 
         # If we are padding here, replace all tokenizer.pad_token_id in the labels by -100 when we want to ignore
         # padding in the loss.
         if padding == "max_length" and args.ignore_pad_token_for_loss:
-            labels["input_ids"] = [
-                [(l if l != tokenizer.pad_token_id else -100) for l in label] for label in labels["input_ids"]
-            ]
+            label_ids           = np.array(labels["input_ids"])
+            labels["input_ids"] = np.where(label_ids == tokenizer.pad_token_id, -100, label_ids).tolist()
         
-        model_inputs["labels"] = labels["input_ids"]
+        model_inputs["labels"]    = labels["input_ids"]
+        model_inputs["row_index"] = indices
         if 'neg_summary' in examples:
             model_inputs["neg_summary"] = neg_summary["input_ids"]
 
@@ -124,11 +161,11 @@ def data_processor(logger, args, accelerator, raw_datasets, tokenizer, model):
     column_names = raw_datasets["pos_data_dict"].column_names
 
 
-    # Get the column names for input/target.
+    # Get the column names for input/target (the dialogue text is referenced by dialogue_row).
     text_column = args.text_column
-    if text_column not in column_names:
+    if text_column != 'dialogue':
         raise ValueError(
-            f"--text_column' value '{args.text_column}' needs to be one of: {', '.join(column_names)}"
+            f"--text_column' value '{args.text_column}' needs to be: dialogue"
         )
 
     summary_column = args.summary_column
@@ -141,21 +178,38 @@ def data_processor(logger, args, accelerator, raw_datasets, tokenizer, model):
     max_target_length = args.max_target_length
     padding = "max_length" if args.pad_to_max_length else False
 
-    with accelerator.main_process_first():
-        processed_datasets = raw_datasets.map(
-            preprocess_function,
-            batched=True,
-            batch_size=1000,
-            remove_columns=column_names,
-            load_from_cache_file=not args.overwrite_cache,
-            desc="Running tokenizer on dataset",
-        )
+    if args.token_store_dir is not None:
+        # token ids are read from the persistent store, only texts it has not seen are tokenized
+        token_store        = TokenStore(args.token_store_dir, tokenizer)
+        processed_datasets = datasets.DatasetDict({
+            name: token_store.processed_dataset(raw_datasets.dialogue_texts(name), raw_datasets[name][summary_column],
+                                                prefix, args, tokenizer.pad_token_id)
+            for name in raw_datasets
+        })
+    else:
+        # every dialogue the samples reference is tokenized once, the rows index into the result
+        dialogue_rows = sorted(set(row for name in raw_datasets for row in raw_datasets[name]['dialogue_row']))
+        source_rows   = {row: index for index, row in enumerate(dialogue_rows)}
+        sources       = tokenizer([prefix + raw_datasets.dialogues[row] for row in dialogue_rows],
+                                  max_length=args.max_source_length, padding=padding, truncation=True)
+        sources       = {key: sources[key] for key in sources.keys()}
+
+        with accelerator.main_process_first():
+            processed_datasets = raw_datasets.map(
+                preprocess_function,
+                batched=True,
+                with_indices=True,
+                batch_size=1000,
+                remove_columns=column_names,
+                load_from_cache_file=not args.overwrite_cache,
+                desc="Running tokenizer on dataset",
+            )
 
     pos_dataset = processed_datasets["pos_data_dict"]
     neg_dataset  = processed_datasets["neg_data_dict"]
 
     # Log a few random samples from the training set:
-    for index in random.sample(range(len(pos_dataset)), 1):
+    for index in random.sample(range(len(pos_dataset)), min(1, len(pos_dataset))):
         logger.info(f"Sample {index} of the training set: {pos_dataset[index]}.")
 
     label_pad_token_id = -100 if args.ignore_pad_token_for_loss else tokenizer.pad_token_id
@@ -166,8 +220,25 @@ def data_processor(logger, args, accelerator, raw_datasets, tokenizer, model):
         pad_to_multiple_of=8 if accelerator.use_fp16 else None,
     )
 
-    pos_dataloader  = DataLoader(pos_dataset, collate_fn=data_collator, batch_size=1)
-    neg_dataloader  = DataLoader(neg_dataset, collate_fn=data_collator, batch_size=1)
+    # sort by (dialogue, summary) length so that each batch needs little padding
+    pos_dataloader  = DataLoader(pos_dataset, collate_fn=data_collator, batch_size=args.per_device_test_batch_size,
+                                 sampler=length_sorted_indices(pos_dataset))
+    neg_dataloader  = DataLoader(neg_dataset, collate_fn=data_collator, batch_size=args.per_device_test_batch_size,
+                                 sampler=length_sorted_indices(neg_dataset))
 
     return (pos_dataloader, neg_dataloader), (pos_dataset, neg_dataset)
 
+
+def length_sorted_indices(dataset):
+    ''' row indices sorted by source then target length, longest first '''
+
+    source_lengths = [len(input_ids) for input_ids in processed_column(dataset, 'input_ids')]
+    target_lengths = [len(labels) for labels in processed_column(dataset, 'labels')]
+
+    return sorted(range(len(dataset)), key=lambda i: (source_lengths[i], target_lengths[i]), reverse=True)
+
+
+def processed_column(dataset, column):
+    ''' one column of a processed dataset (an empty split has no columns at all) '''
+
+    return dataset[column] if len(dataset) > 0 else []
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+###
+# Author: Bin Wang
+# -----
+# Copyright (c) 2022 National University of Singapore
+# -----
+
+
+import os
+import json
+import hashlib
+import logging
+
+import numpy as np
+
+from score_cache import sample_key
+from metrics import marker_labels, scored_dialogues, pairwise_ranking_scores, marker_result
+
+
+MANIFEST_VERSION = 1
+
+
+def manifest_key(namespace, dialogue, summary):
+    ''' content hash of one (dialogue, summary) pair under a scoring namespace (see score_cache.scoring_namespace) '''
+
+    return hashlib.sha256((namespace + '\x00' + sample_key(dialogue, summary)).encode('utf-8')).hexdigest()
+
+
+def dialogue_hash(pos_keys, neg_keys):
+    ''' hash of the pos / neg rows one per-dialogue result is computed from '''
+
+    return hashlib.sha256(json.dumps([sorted(pos_keys), sorted(neg_keys)]).encode('utf-8')).hexdigest()
+
+
+class Manifest():
+    # What the previous run over the sample set computed (--manifest_file): the log-prob of every
+    # (dialogue, summary) pair keyed by its content hash, and the per-dialogue result of every
+    # error type with the hash of the rows it came from. When the sample set grows or is edited,
+    # only the pairs missing from the manifest are scored and only the (error type, dialogue)
+    # results whose rows changed are recomputed. The keys include the scoring namespace, so a
+    # different model, tokenizer or preprocessing matches nothing.
+
+    def __init__(self, path):
+        self.path       = path
+        self.probs      = {}
+        self.dialogues  = {}
+        self.tie_policy = None
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                saved = json.load(f)
+            if saved.get('version') == MANIFEST_VERSION:
+                self.probs, self.dialogues, self.tie_policy = saved['probs'], saved['dialogues'], saved['tie_policy']
+            else:
+                logging.warning("Ignoring the manifest {} written by another version".format(path))
+
+    def save(self):
+        ''' tmp file + rename, an interrupted run keeps the previous manifest '''
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'version'   : MANIFEST_VERSION,
+                       'tie_policy': self.tie_policy,
+                       'probs'     : self.probs,
+                       'dialogues' : self.dialogues}, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    def update(self, keys, probs, dialogues, tie_policy):
+        ''' replace the content with the current run, rows that left the sample set are dropped '''
+
+        self.probs      = dict(zip(keys, probs))
+        self.dialogues  = dialogues
+        self.tie_policy = tie_policy
+
+
+def incremental_scores(manifest, pos_ids, pos_keys, pos_probs, neg_ids, neg_keys, neg_labels, neg_probs, neg_markers,
+                       tie_policy='strict', num_bootstrap=1000, seed=None):
+    ''' metrics.aggregate_scores, reusing the per-dialogue results of the manifest whose rows did not change
+
+        Returns the results (identical to aggregate_scores), the per-dialogue entries for the next
+        manifest {marker: {dialogue id: {hash, score, pairs, ties}}} and the number of recomputed results.
+    '''
+
+    pos_ids, pos_probs = np.asarray(pos_ids), np.asarray(pos_probs, dtype=np.float64)
+    neg_ids, neg_probs = np.asarray(neg_ids), np.asarray(neg_probs, dtype=np.float64)
+    neg_keys           = np.asarray(neg_keys, dtype=str)
+    labels, label_code = np.unique(np.asarray(neg_labels), return_inverse=True)
+    label_code         = label_code.reshape(-1)
+
+    pos_rows = {}
+    for sample_id, key in zip(pos_ids.tolist(), pos_keys):
+        pos_rows.setdefault(str(sample_id), []).append(key)
+
+    previous = manifest.dialogues if manifest.tie_policy == tie_policy else {}
+
+    results, dialogues, num_recomputed = {}, {}, 0
+    for neg_marker in neg_markers:
+        mask     = np.isin(labels, marker_labels(neg_marker, labels))[label_code]
+        neg_rows = {}
+        for sample_id, key in zip(neg_ids[mask].tolist(), neg_keys[mask].tolist()):
+            neg_rows.setdefault(str(sample_id), []).append(key)
+
+        dialogue_ids = scored_dialogues(pos_ids, neg_ids[mask])
+        stored       = previous.get(neg_marker, {})
+        entries      = {}
+        for dialogue_id in map(str, dialogue_ids.tolist()):
+            row_hash = dialogue_hash(pos_rows[dialogue_id], neg_rows[dialogue_id])
+            if dialogue_id in stored and stored[dialogue_id]['hash'] == row_hash:
+                entries[dialogue_id] = stored[dialogue_id]
+            else:
+                entries[dialogue_id] = {'hash': row_hash}
+
+        changed = [dialogue_id for dialogue_id, entry in entries.items() if 'score' not in entry]
+        if changed:
+            changed_ids = dialogue_ids[np.isin(dialogue_ids.astype(str), changed)]
+            pos_mask    = np.isin(pos_ids, changed_ids)
+            neg_mask    = mask & np.isin(neg_ids, changed_ids)
+            ranked      = pairwise_ranking_scores(pos_ids[pos_mask], pos_probs[pos_mask], neg_ids[neg_mask],
+                                                  neg_probs[neg_mask], tie_policy)
+            for dialogue_id, score, pairs, ties in zip(ranked['dialogue_ids'], ranked['scores'], ranked['pairs'], ranked['ties']):
+                entries[str(dialogue_id)].update(score=float(score), pairs=int(pairs), ties=int(ties))
+            num_recomputed += len(changed)
+
+        results[neg_marker] = marker_result(
+            dialogue_ids  = dialogue_ids,
+            scores        = [entries[dialogue_id]['score'] for dialogue_id in entries],
+            pairs         = [entries[dialogue_id]['pairs'] for dialogue_id in entries],
+            ties          = [entries[dialogue_id]['ties'] for dialogue_id in entries],
+            tie_policy    = tie_policy,
+            num_bootstrap = num_bootstrap,
+            seed          = seed,
+        )
+        dialogues[neg_marker] = entries
+
+    return results, dialogues, num_recomputed
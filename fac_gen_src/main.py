@@ -8,12 +8,12 @@
 
 
 import os
+import json
+import time
 import logging
 
 import nltk
-import numpy as np
 import torch
-from tqdm.auto import tqdm
 
 import transformers
 from accelerate import Accelerator
@@ -24,8 +24,16 @@ from transformers.file_utils import is_offline_mode
 from transformers.utils.versions import require_version
 
 from args import parse_args
-from data_loader import raw_data_loader, data_processor
+from data_loader import raw_data_loader, data_processor, processed_column
 from model_loader import model_loader
+from scorer import compute_sample_probs, compute_grouped_sample_probs
+from score_cache import ScoreCache, DigestMemo, sample_key, scoring_namespace
+from metrics import aggregate_scores
+from incremental import Manifest, manifest_key, incremental_scores
+from sharding import SPLITS, shard_rows, run_fingerprint, clear_stale_partials, write_partial, missing_partials, merge_partials
+from precision import apply_precision, precision_context, first_dialogue_rows, agreement_report
+from onnx_backend import OnnxScorer, export_fingerprint, is_exported, export_onnx, parity_report
+from profiler import Profiler, NULL_PROFILER, torch_profile
 
 
 # =  =  =  =  =  =  =  =  =  = Logging Setup =  =  =  =  =  =  =  =  =  =  =  = 
@@ -61,7 +69,8 @@ def main():
     logging.info("")
 
     # Initialize the accelerator. The accelerator will handle device placement for us.
-    accelerator = Accelerator()
+    # Without a GPU, processes launched by accelerate / torchrun join a CPU (gloo) process group.
+    accelerator = Accelerator(cpu=not torch.cuda.is_available())
     logger.info(accelerator.state)
 
     # Setup logging, we only want one process per machine to log things on the screen.
@@ -87,109 +96,329 @@ def main():
 
     accelerator.wait_for_everyone()
 
-    # load raw dataset
-    raw_datasets = raw_data_loader(args)
+    # every process scores one shard of the dialogues (CPU cores are split between the processes of a machine)
+    num_shards = args.num_shards if args.num_shards is not None else accelerator.num_processes
+    shard_id   = args.shard_id if args.shard_id is not None else accelerator.process_index
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    elif accelerator.num_processes > 1:
+        torch.set_num_threads(max(1, os.cpu_count() // int(os.environ.get('LOCAL_WORLD_SIZE', accelerator.num_processes))))
 
-    # load model (config, tokenizer, s2s model)
-    config, tokenizer, model = model_loader(accelerator, logger, args)
-    
-    # data processor (for DataLoader)
-    dataloader    , processed_dataset = data_processor(logger, args, accelerator, raw_datasets, tokenizer, model)
-    pos_dataloader, neg_dataloader    = dataloader
+    fingerprint = None
+    if not args.merge_only:
+        fingerprint = score_shard(args, accelerator, shard_id, num_shards)
 
-    model, pos_dataloader, neg_dataloader = accelerator.prepare(model, pos_dataloader, neg_dataloader)
+    accelerator.wait_for_everyone()
+
+    # =  =  =  =  =  =  =  =  =  =  =  =  =  =  =  = Merge Shards and Compute Scores =  =  =  =  =  =  =  =  =  =  =  =  =  =  = 
+    if not accelerator.is_main_process:
+        return
+
+    # only partials of this run (same model, sample set, error types and shards) are merged
+    if fingerprint is None:
+        config, tokenizer, model = model_loader(accelerator, logger, args, load_model=not os.path.isdir(args.model_name_or_path))
+        fingerprint = run_fingerprint(args, scoring_namespace(args, config, tokenizer, model), num_shards)
+
+    missing = missing_partials(args.output_dir, num_shards, fingerprint)
+    if missing:
+        logger.info("Shards {} of {} are not scored yet, run with --merge_only once they finish.".format(missing, num_shards))
+        return
+    merged = merge_partials(args.output_dir, num_shards, fingerprint)
+
+    # Compute average scores for each error type
+    if args.manifest_file is not None:
+        # incremental: per-dialogue results of the previous run are reused where their rows did not change
+        manifest = Manifest(args.manifest_file)
+        results, dialogues, num_recomputed = incremental_scores(
+            manifest      = manifest,
+            pos_ids       = merged['pos_data_dict']['id'],
+            pos_keys      = merged['pos_data_dict']['key'],
+            pos_probs     = merged['pos_data_dict']['prob'],
+            neg_ids       = merged['neg_data_dict']['id'],
+            neg_keys      = merged['neg_data_dict']['key'],
+            neg_labels    = merged['neg_data_dict']['marker'],
+            neg_probs     = merged['neg_data_dict']['prob'],
+            neg_markers   = args.neg_markers,
+            tie_policy    = args.tie_policy,
+            num_bootstrap = args.num_bootstrap,
+            seed          = args.seed,
+        )
+        logger.info("Manifest: {} of {} per-dialogue results recomputed.".format(
+            num_recomputed, sum(len(entries) for entries in dialogues.values())))
+
+        manifest.update(merged['pos_data_dict']['key'] + merged['neg_data_dict']['key'],
+                        merged['pos_data_dict']['prob'] + merged['neg_data_dict']['prob'], dialogues, args.tie_policy)
+        manifest.save()
+    else:
+        results = aggregate_scores(
+            pos_ids       = merged['pos_data_dict']['id'],
+            pos_probs     = merged['pos_data_dict']['prob'],
+            neg_ids       = merged['neg_data_dict']['id'],
+            neg_labels    = merged['neg_data_dict']['marker'],
+            neg_probs     = merged['neg_data_dict']['prob'],
+            neg_markers   = args.neg_markers,
+            tie_policy    = args.tie_policy,
+            num_bootstrap = args.num_bootstrap,
+            seed          = args.seed,
+        )
+
+    for neg_marker, result in results.items():
+        logger.info("{}: {}".format(neg_marker, result['score']))
+        with open(args.output_dir + '/' + neg_marker + '_score.txt', 'w') as f:
+            f.write(str(result['score']))
+
+    with open(os.path.join(args.output_dir, 'faceval_scores.json'), 'w') as f:
+        json.dump(results, f, indent=4)
+
+
+def content_namespace(args, config, tokenizer, model, score_cache=None):
+    ''' scoring namespace of log-probs reused across runs (score cache, manifest)
+
+        Keyed by the weight contents, hashed once and memoised in the score cache or next to the manifest.
+    '''
+
+    if score_cache is not None:
+        return score_cache.set_namespace(args, config, tokenizer, model)
+    return scoring_namespace(args, config, tokenizer, model, file_digests=DigestMemo(args.manifest_file + '.weights.json'))
+
+
+def score_shard(args, accelerator, shard_id, num_shards):
+    ''' score the pos / neg summaries of the dialogues in one shard and write them as partial results
+
+        Returns the run fingerprint the partial results are stamped with.
+    '''
+
+    # per-stage timers (--profile), written to output_dir/profile[_shard{i}-of-{n}].json
+    profiler = Profiler(enabled=args.profile or args.profile_torch, device=accelerator.device,
+                        name='profile' if num_shards == 1 else 'profile_shard{}-of-{}'.format(shard_id, num_shards))
+
+    # load raw dataset, keep the rows of this shard
+    with profiler.stage('load_data'):
+        raw_datasets = raw_data_loader(args)
+    num_rows     = {split: len(raw_datasets[split]) for split in SPLITS}
+    rows         = {split: shard_rows(raw_datasets[split]['id'], shard_id, num_shards) for split in SPLITS}
+    raw_datasets = raw_datasets.select_rows(rows)
+    logger.info("Shard {} of {}: {} pos / {} neg samples.".format(
+        shard_id, num_shards, len(rows['pos_data_dict']), len(rows['neg_data_dict'])))
+
+    # load model (config, tokenizer, s2s model), the ONNX backend only needs the torch model to export it
+    score_cache = ScoreCache(args.score_cache_dir) if args.score_cache_dir is not None else None
+    onnx_dir    = args.onnx_dir if args.onnx_dir is not None else os.path.join(args.output_dir, 'onnx')
+    model_ids   = {}
+    def needs_torch_model(config, tokenizer):
+        # an export of this very model (matched by config and weight files) makes the torch model unnecessary
+        if args.backend == 'torch':
+            return True
+        model_ids['export'] = export_fingerprint(args.model_name_or_path, config, None)
+        return not is_exported(onnx_dir, model_ids['export'])
+    config, tokenizer, model = model_loader(accelerator, logger, args, load_model=needs_torch_model, profiler=profiler)
+
+    if model is not None:
+        model = accelerator.prepare(model)
+        model.eval()
+    torch_model = accelerator.unwrap_model(model) if model is not None else None
+
+    if args.backend == 'onnx':
+        exported = False
+        with accelerator.main_process_first():
+            # without the torch model the export already matched it, an export of another model is replaced
+            if torch_model is not None:
+                # computed once, from the state dict only when the weight files are not local
+                model_id = model_ids.get('export')
+                if model_id is None:
+                    model_id = export_fingerprint(args.model_name_or_path, config, torch_model)
+                if not is_exported(onnx_dir, model_id):
+                    logger.info("Exporting the model to ONNX in {}".format(onnx_dir))
+                    export_onnx(torch_model, onnx_dir, model_id)
+                    exported = True
+        scoring_model = OnnxScorer(onnx_dir, tokenizer.pad_token_id, config.decoder_start_token_id, torch.get_num_threads())
+
+        # right after the export, compare with the PyTorch model on the first dialogues
+        if exported and args.agreement_first_dialogues > 0 and shard_id == 0:
+            check_onnx_parity(args, accelerator, raw_datasets, tokenizer, model, scoring_model, onnx_dir)
+    else:
+        # reduced-precision copy used for scoring (the fp32 model is kept for the agreement report)
+        scoring_model = apply_precision(torch_model, args.precision)
 
+    # partial results of earlier runs in output_dir are never merged with this one (weight files are only stamped)
+    fingerprint = run_fingerprint(args, scoring_namespace(args, config, tokenizer, torch_model), num_shards)
+    stale       = clear_stale_partials(args.output_dir, fingerprint)
+    if stale:
+        logger.info("Removed partial results of another run: {}".format(stale))
 
     # =  =  =  =  =  =  =  =  =  =  =  =  =  =  =  = Extrac Generation Probabilities =  =  =  =  =  =  =  =  =  =  =  =  =  =  = 
-    model.eval()
-
-    # compute positive probability
-    index            = 0
-    pos_sample_probs = {}
-    id_list          = raw_datasets['pos_data_dict']['id']
-    for _, batch in enumerate(tqdm(pos_dataloader)):
-        outputs       = model(**batch)
-        output_logits = outputs.logits
-        output_probs  = torch.nn.functional.softmax(output_logits, dim=-1)
-        gt_logits     = batch['labels']
-
-        lprobs, target = output_probs, gt_logits
-
-        ignore_index = -100
-        lprobs       = lprobs[~target.eq(ignore_index)]
-        target       = target[~target.eq(ignore_index)]
-
-        if target.dim() == lprobs.dim() - 1:
-            target = target.unsqueeze(-1)
-
-        predict_prob = lprobs.gather(dim=-1, index=target)
-        predict_prob = predict_prob.cpu().detach().numpy()
-        predict_prob = np.log(predict_prob)
-        predict_prob = predict_prob.mean()
-        predict_prob = float(predict_prob)
-
-        if id_list[index] not in pos_sample_probs:
-            pos_sample_probs[id_list[index]] = [predict_prob]
-        else:
-            pos_sample_probs[id_list[index]].append(predict_prob)
-        index += 1
-
-    # Compute negative probability
-    index            = 0
-    neg_sample_probs = {}
-    id_list          = raw_datasets['neg_data_dict']['id']
-    for _, batch in enumerate(tqdm(neg_dataloader)):
-        outputs       = model(**batch)
-        output_logits = outputs.logits
-        output_probs  = torch.nn.functional.softmax(output_logits, dim=-1)
-        gt_logits     = batch['labels']
-
-        lprobs, target = output_probs, gt_logits
-
-        ignore_index = -100
-        lprobs       = lprobs[~target.eq(ignore_index)]
-        target       = target[~target.eq(ignore_index)]
-
-        if target.dim() == lprobs.dim() - 1:
-            target = target.unsqueeze(-1)
-
-        predict_prob = lprobs.gather(dim=-1, index=target)
-        predict_prob = predict_prob.cpu().detach().numpy()
-        predict_prob = np.log(predict_prob)
-        predict_prob = predict_prob.mean()
-        predict_prob = float(predict_prob)
-
-        if id_list[index] not in neg_sample_probs:
-            neg_sample_probs[id_list[index]] = [predict_prob]
-        else:
-            neg_sample_probs[id_list[index]].append(predict_prob)
-        index += 1
+    columns = {split: {} for split in SPLITS}
+    if args.score_cache_dir is not None or args.manifest_file is not None:
+        # only samples missing from the persistent cache / the manifest of the previous run go through the model
+        namespace   = content_namespace(args, config, tokenizer, torch_model, score_cache)
+        sample_keys = {name: [sample_key(dialogue, summary) for dialogue, summary
+                              in zip(raw_datasets.dialogue_texts(name), raw_datasets[name]['summary'])]
+                       for name in raw_datasets}
+        cached      = {}
+        if score_cache is not None:
+            with profiler.stage('score_cache'):
+                cached = score_cache.get_many(sample_keys['pos_data_dict'] + sample_keys['neg_data_dict'])
+        if args.manifest_file is not None:
+            # content hashes of the rows, written to the partials for the manifest of this run
+            for name in raw_datasets:
+                columns[name]['key'] = [manifest_key(namespace, dialogue, summary) for dialogue, summary
+                                        in zip(raw_datasets.dialogue_texts(name), raw_datasets[name]['summary'])]
+            known = Manifest(args.manifest_file).probs
+            for name in raw_datasets:
+                for key, row_key in zip(sample_keys[name], columns[name]['key']):
+                    if row_key in known:
+                        cached.setdefault(key, known[row_key])
+        sample_probs = {name: [cached.get(key) for key in sample_keys[name]] for name in raw_datasets}
+
+        missing_rows = {name: [index for index, prob in enumerate(sample_probs[name]) if prob is None]
+                        for name in raw_datasets}
+        logger.info("Reused log-probs: {} hits, {} misses.".format(
+            sum(len(probs) for probs in sample_probs.values()) - sum(len(rows) for rows in missing_rows.values()),
+            sum(len(rows) for rows in missing_rows.values())))
+
+        if any(missing_rows.values()):
+            missing_datasets = raw_datasets.select_rows(missing_rows)
+            new_pos_probs, new_neg_probs = score_datasets(args, accelerator, missing_datasets, tokenizer, scoring_model,
+                                                          args.precision, profiler)
+
+            new_items = []
+            for name, new_probs in (('pos_data_dict', new_pos_probs), ('neg_data_dict', new_neg_probs)):
+                for index, predict_prob in zip(missing_rows[name], new_probs):
+                    sample_probs[name][index] = predict_prob
+                    new_items.append((sample_keys[name][index], predict_prob))
+            if score_cache is not None:
+                with profiler.stage('score_cache'):
+                    score_cache.put_many(new_items)
+
+        pos_probs, neg_probs = sample_probs['pos_data_dict'], sample_probs['neg_data_dict']
+    else:
+        pos_probs, neg_probs = score_datasets(args, accelerator, raw_datasets, tokenizer, scoring_model, args.precision,
+                                              profiler)
 
-    # Compute average scores
-    scores = []
-    for key, values in pos_sample_probs.items():
-        positive_values = values
+    columns['pos_data_dict'].update({'id': raw_datasets['pos_data_dict']['id'], 'prob': pos_probs})
+    columns['neg_data_dict'].update({'id'    : raw_datasets['neg_data_dict']['id'],
+                                     'marker': raw_datasets['neg_data_dict']['marker'],
+                                     'prob'  : neg_probs})
+    write_partial(args.output_dir, shard_id, num_shards, num_rows, rows, columns, fingerprint)
 
-        if key in neg_sample_probs:
-            negative_values = neg_sample_probs[key]
-        else:
-            continue
+    if args.precision != 'fp32' and args.agreement_first_dialogues > 0 and shard_id == 0:
+        write_agreement_report(args, accelerator, raw_datasets, tokenizer, model, scoring_model)
 
-        all_comparison = []
-        for pos_value in positive_values:
-            for neg_value in negative_values:
-                if pos_value > neg_value: 
-                    all_comparison.append(1) 
-                else:
-                    all_comparison.append(0)
+    if profiler.enabled:
+        profiler.add_section('run', {
+            'model'     : args.model_name_or_path,
+            'backend'   : args.backend,
+            'precision' : args.precision,
+            'batch_size': args.per_device_test_batch_size,
+            'grouped'   : bool(args.reuse_encoder or isinstance(scoring_model, OnnxScorer)),
+            'threads'   : torch.get_num_threads(),
+            'shard'     : [shard_id, num_shards],
+            'pos_rows'  : len(raw_datasets['pos_data_dict']),
+            'neg_rows'  : len(raw_datasets['neg_data_dict']),
+        })
+        logger.info("Profile written to {}".format(profiler.write(args.output_dir)))
 
-        scores.append(np.mean(all_comparison))
-    
-    final_score = np.mean(scores)
+    return fingerprint
+
+
+def check_onnx_parity(args, accelerator, raw_datasets, tokenizer, model, onnx_model, onnx_dir):
+    ''' score the first dialogues with PyTorch and ONNX Runtime, fail if they disagree '''
+
+    rows   = first_dialogue_rows(raw_datasets, args.agreement_first_dialogues)
+    subset = raw_datasets.select_rows(rows)
+
+    torch_pos_probs, torch_neg_probs = score_datasets(args, accelerator, subset, tokenizer, model)
+    onnx_pos_probs , onnx_neg_probs  = score_datasets(args, accelerator, subset, tokenizer, onnx_model)
+
+    report = parity_report(torch_pos_probs + torch_neg_probs, onnx_pos_probs + onnx_neg_probs, args.onnx_parity_tol)
+    logger.info("ONNX Runtime vs PyTorch on {} samples: max |diff| {:.4g}".format(report['num_samples'], report['max_abs_diff']))
+
+    with open(os.path.join(onnx_dir, 'parity.json'), 'w') as f:
+        json.dump(report, f, indent=4)
+
+    if not report['passed']:
+        raise ValueError("ONNX Runtime log-probs differ from PyTorch by {} (> {}), see {}".format(
+            report['max_abs_diff'], args.onnx_parity_tol, os.path.join(onnx_dir, 'parity.json')))
+
+
+def write_agreement_report(args, accelerator, raw_datasets, tokenizer, model, scoring_model):
+    ''' score the first dialogues in fp32 and in the reduced precision, and compare the two '''
+
+    rows   = first_dialogue_rows(raw_datasets, args.agreement_first_dialogues)
+    subset = raw_datasets.select_rows(rows)
+
+    probs = {}
+    for precision, precision_model in (('fp32', model), (args.precision, scoring_model)):
+        start = time.time()
+        pos_probs, neg_probs = score_datasets(args, accelerator, subset, tokenizer, precision_model, precision)
+        probs[precision] = {'pos': pos_probs, 'neg': neg_probs, 'seconds': time.time() - start}
+
+    report = agreement_report(
+        precision   = args.precision,
+        reference   = probs['fp32'],
+        reduced     = probs[args.precision],
+        pos_ids     = subset['pos_data_dict']['id'],
+        neg_ids     = subset['neg_data_dict']['id'],
+        neg_labels  = subset['neg_data_dict']['marker'],
+        neg_markers = args.neg_markers,
+        tie_policy  = args.tie_policy,
+    )
+    logger.info("{} vs fp32 on {} samples: max |diff| {:.4g}, pair order agreement {}, speedup {}".format(
+        args.precision, report['num_samples'], report['max_abs_diff'], report['pair_order_agreement'], report['speedup']))
+
+    with open(os.path.join(args.output_dir, 'precision_agreement.json'), 'w') as f:
+        json.dump(report, f, indent=4)
+
+
+def score_datasets(args, accelerator, raw_datasets, tokenizer, model, precision='fp32', profiler=NULL_PROFILER):
+    ''' mean log-probability of every pos / neg summary, aligned with the raw dataset rows '''
+
+    if profiler.enabled and args.profile_warmup > 0:
+        # untimed by the scoring stages: the first forward passes pay one-time setup (allocator, kernel selection)
+        num_rows = args.profile_warmup * args.per_device_test_batch_size
+        warmup   = raw_datasets.select_rows({split: range(min(num_rows, len(raw_datasets[split]))) for split in raw_datasets})
+        with profiler.stage('warmup'):
+            _score_datasets(args, accelerator, warmup, tokenizer, model, precision, NULL_PROFILER)
+
+    with profiler.stage('score'), torch_profile(profiler, args.output_dir, enabled=args.profile_torch and profiler.enabled):
+        return _score_datasets(args, accelerator, raw_datasets, tokenizer, model, precision, profiler)
+
+
+def _score_datasets(args, accelerator, raw_datasets, tokenizer, model, precision, profiler):
+
+    # data processor (for DataLoader)
+    with profiler.stage('tokenize'):
+        dataloader    , processed_dataset = data_processor(logger, args, accelerator, raw_datasets, tokenizer,
+                                                           accelerator.unwrap_model(model))
+    pos_dataloader, neg_dataloader    = dataloader
+
+    with precision_context(precision, accelerator.device):
+        if args.reuse_encoder or isinstance(model, OnnxScorer):
+            # encode every dialogue once and score all of its pos / neg summaries against it
+            pos_dataset, neg_dataset = processed_dataset
+            grouped_inputs = dict(
+                input_ids  = processed_column(pos_dataset, 'input_ids') + processed_column(neg_dataset, 'input_ids'),
+                labels     = processed_column(pos_dataset, 'labels') + processed_column(neg_dataset, 'labels'),
+                sample_ids = raw_datasets['pos_data_dict']['id'] + raw_datasets['neg_data_dict']['id'],
+                batch_size = args.per_device_test_batch_size,
+                profiler   = profiler,
+            )
+            if isinstance(model, OnnxScorer):
+                sample_probs = model.score(**grouped_inputs)
+            else:
+                sample_probs = compute_grouped_sample_probs(accelerator.unwrap_model(model), pad_token_id=tokenizer.pad_token_id,
+                                                            device=accelerator.device, **grouped_inputs)
+            pos_probs = sample_probs[:len(pos_dataset)]
+            neg_probs = sample_probs[len(pos_dataset):]
+        else:
+            # the dataloaders are not prepared by accelerate, every process already holds its own shard
+            # compute positive probability (once, shared by all error types)
+            pos_probs = compute_sample_probs(accelerator.unwrap_model(model), pos_dataloader, accelerator.device, profiler)
+            # Compute negative probability (once, for the union of all requested error types)
+            neg_probs = compute_sample_probs(accelerator.unwrap_model(model), neg_dataloader, accelerator.device, profiler)
+
+    return pos_probs, neg_probs
 
-    with open(args.output_dir + '/' + args.neg_marker + '_score.txt', 'w') as f:
-        f.write(str(final_score))
-        
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 # Main Process
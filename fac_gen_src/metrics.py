@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+###
+# Author: Bin Wang
+# -----
+# Copyright (c) 2022 National University of Singapore
+# -----
+
+
+import numpy as np
+
+
+# credit given to a (pos, neg) pair with equal scores
+TIE_CREDIT = {'strict': 0.0, 'half': 0.5}
+
+# label of the faithful summaries, and the marker that selects every negative whatever its error type
+POS_LABEL     = 'pos'
+ALL_NEGATIVES = '_neg'
+
+
+def marker_labels(neg_marker, labels):
+    ''' labels selected by an error type marker: exactly itself, or every negative label for ALL_NEGATIVES '''
+
+    if neg_marker == ALL_NEGATIVES:
+        return [label for label in labels if label != POS_LABEL]
+    return [label for label in labels if label == neg_marker]
+
+
+def pairwise_ranking_scores(pos_ids, pos_probs, neg_ids, neg_probs, tie_policy='strict'):
+    ''' per-dialogue fraction of (pos, neg) pairs in which the positive summary scores higher
+
+        Only dialogues with both positive and negative summaries are scored, in order of
+        first appearance among the positives. Instead of comparing every pair, each
+        (dialogue, score) is packed into one integer key and the negatives below / equal to
+        every positive are counted with searchsorted on the sorted negative keys.
+    '''
+
+    pos_ids, pos_probs = np.asarray(pos_ids), np.asarray(pos_probs, dtype=np.float64)
+    neg_ids, neg_probs = np.asarray(neg_ids), np.asarray(neg_probs, dtype=np.float64)
+
+    dialogue_ids  = scored_dialogues(pos_ids, neg_ids)
+    num_dialogues = len(dialogue_ids)
+
+    pos_code, pos_valid = _dialogue_codes(dialogue_ids, pos_ids)
+    neg_code, neg_valid = _dialogue_codes(dialogue_ids, neg_ids)
+    pos_code, pos_probs = pos_code[pos_valid], pos_probs[pos_valid]
+    neg_code, neg_probs = neg_code[neg_valid], neg_probs[neg_valid]
+
+    # exact integer ranks of all scores (equal scores share a rank)
+    _, ranks  = np.unique(np.concatenate([pos_probs, neg_probs]), return_inverse=True)
+    ranks     = ranks.reshape(-1)
+    num_ranks = int(ranks.max()) + 1 if len(ranks) else 1
+
+    pos_key = pos_code * num_ranks + ranks[:len(pos_probs)]
+    neg_key = np.sort(neg_code * num_ranks + ranks[len(pos_probs):])
+
+    start = np.searchsorted(neg_key, pos_code * num_ranks, side='left')
+    lower = np.searchsorted(neg_key, pos_key, side='left')
+    upper = np.searchsorted(neg_key, pos_key, side='right')
+
+    wins  = np.bincount(pos_code, weights=lower - start, minlength=num_dialogues)
+    ties  = np.bincount(pos_code, weights=upper - lower, minlength=num_dialogues)
+    pairs = np.bincount(pos_code, minlength=num_dialogues) * np.bincount(neg_code, minlength=num_dialogues)
+
+    return {
+        'dialogue_ids': dialogue_ids,
+        'scores'      : (wins + TIE_CREDIT[tie_policy] * ties) / pairs,
+        'pairs'       : pairs,
+        'ties'        : ties.astype(np.int64),
+    }
+
+
+def scored_dialogues(pos_ids, neg_ids):
+    ''' dialogues with both positive and negative summaries, in order of first appearance among the positives '''
+
+    pos_ids        = np.asarray(pos_ids)
+    _, first_index = np.unique(pos_ids, return_index=True)
+    dialogue_ids   = pos_ids[np.sort(first_index)]
+
+    return dialogue_ids[np.isin(dialogue_ids, neg_ids)]
+
+
+def _dialogue_codes(dialogue_ids, ids):
+    ''' position of every id in dialogue_ids, and whether it is there at all '''
+
+    if len(dialogue_ids) == 0:
+        return np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=bool)
+
+    sorter   = np.argsort(dialogue_ids)
+    position = np.searchsorted(dialogue_ids, ids, sorter=sorter).clip(max=len(dialogue_ids) - 1)
+    code     = sorter[position]
+
+    return code, dialogue_ids[code] == ids
+
+
+def bootstrap_interval(scores, num_samples=1000, confidence=0.95, seed=None):
+    ''' percentile bootstrap interval of the mean score, resampling dialogues '''
+
+    if len(scores) == 0 or num_samples <= 0:
+        return None
+
+    rng     = np.random.RandomState(seed)
+    samples = scores[rng.randint(0, len(scores), size=(num_samples, len(scores)))].mean(axis=1)
+    low, high = np.percentile(samples, [50 * (1 - confidence), 50 * (1 + confidence)])
+
+    return {
+        'num_samples': num_samples,
+        'confidence' : confidence,
+        'low'        : float(low),
+        'high'       : float(high),
+        'std'        : float(samples.std()),
+    }
+
+
+def aggregate_scores(pos_ids, pos_probs, neg_ids, neg_labels, neg_probs, neg_markers,
+                     tie_policy='strict', num_bootstrap=1000, seed=None):
+    ''' FacEval score, per-dialogue scores and bootstrap interval for every error type '''
+
+    neg_ids, neg_probs = np.asarray(neg_ids), np.asarray(neg_probs, dtype=np.float64)
+    labels, label_code = np.unique(np.asarray(neg_labels), return_inverse=True)
+    label_code         = label_code.reshape(-1)
+
+    results = {}
+    for neg_marker in neg_markers:
+        mask   = np.isin(labels, marker_labels(neg_marker, labels))[label_code]
+        ranked = pairwise_ranking_scores(pos_ids, pos_probs, neg_ids[mask], neg_probs[mask], tie_policy)
+        results[neg_marker] = marker_result(ranked['dialogue_ids'], ranked['scores'], ranked['pairs'], ranked['ties'],
+                                            tie_policy, num_bootstrap, seed)
+
+    return results
+
+
+def marker_result(dialogue_ids, scores, pairs, ties, tie_policy='strict', num_bootstrap=1000, seed=None):
+    ''' FacEval score of one error type from its per-dialogue scores / pair counts '''
+
+    scores = np.asarray(scores, dtype=np.float64)
+    pairs  = np.asarray(pairs, dtype=np.int64)
+    ties   = np.asarray(ties, dtype=np.int64)
+
+    return {
+        'score'        : float(np.mean(scores)) if len(scores) else float('nan'),
+        'tie_policy'   : tie_policy,
+        'num_dialogues': len(scores),
+        'num_pairs'    : int(pairs.sum()),
+        'num_ties'     : int(ties.sum()),
+        'bootstrap'    : bootstrap_interval(scores, num_bootstrap, seed=seed),
+        'per_dialogue' : {
+            str(dialogue_id): {'score': float(score), 'pairs': int(pair_count), 'ties': int(tie_count)}
+            for dialogue_id, score, pair_count, tie_count in zip(dialogue_ids, scores, pairs, ties)
+        },
+    }
@@ -6,15 +6,33 @@
 # Copyright (c) 2022 National University of Singapore
 # -----
 
+import os
+import time
+import inspect
+
+import torch
 from transformers import (
     CONFIG_MAPPING,
     AutoConfig,
     AutoModelForSeq2SeqLM,
     AutoTokenizer,
 )
+from transformers.modeling_utils import no_init_weights
+
+from profiler import NULL_PROFILER
+
+SAFETENSORS_FILE = 'model.safetensors'
+
+
+def model_loader(accelerator, logger, args, load_model=True, profiler=NULL_PROFILER):
+    ''' load transformer models (config, tokenizer, s2s model), the model is None without load_model
+
+        load_model may also be a function of (config, tokenizer), e.g. to skip the weights when
+        an ONNX export of them already exists.
+    '''
 
-def model_loader(accelerator, logger, args):
-    ''' load transformer models (config, tokenizer, s2s model) '''
+    load_times = {}
+    start      = time.time()
 
     # model config
     if args.config_name:
@@ -24,6 +42,7 @@ def model_loader(accelerator, logger, args):
     else:
         config = CONFIG_MAPPING[args.model_type]()
         logger.warning("You are instantiating a new config instance from scratch.")
+    load_times['config'], start = time.time() - start, time.time()
 
     # tokenizer
     if args.tokenizer_name:
@@ -35,21 +54,82 @@ def model_loader(accelerator, logger, args):
             "You are instantiating a new tokenizer from scratch. This is not supported by this script."
             "You can do it from another script, save it, and load it from here, using --tokenizer_name."
         )
-    
-    ori_tokenizer_len = len(tokenizer)
+    load_times['tokenizer'], start = time.time() - start, time.time()
 
-    # model
-    model = AutoModelForSeq2SeqLM.from_pretrained(
-        args.model_name_or_path,
-        from_tf=bool(".ckpt" in args.model_name_or_path),
-        config=config,
-        cache_dir=args.cache_dir,
-    )
+    if callable(load_model):
+        load_model = load_model(config, tokenizer)
+    if not load_model:
+        logger.info("Load time: {}".format(format_load_times(load_times)))
+        profiler.add_section('model_load', load_times)
+        return config, tokenizer, None
 
-    model.resize_token_embeddings(ori_tokenizer_len)
-    model.resize_token_embeddings(len(tokenizer))
+    # model, straight from memory-mapped safetensors weights when the model dir has them
+    safetensors_file = os.path.join(args.model_name_or_path, SAFETENSORS_FILE)
+    if os.path.isfile(safetensors_file):
+        model = fast_load_model(safetensors_file, config, logger)
+        load_times['weights (safetensors mmap)'] = time.time() - start
+    else:
+        model = AutoModelForSeq2SeqLM.from_pretrained(
+            args.model_name_or_path,
+            from_tf=bool(".ckpt" in args.model_name_or_path),
+            config=config,
+            cache_dir=args.cache_dir,
+        )
+        load_times['weights (from_pretrained)'] = time.time() - start
+    start = time.time()
+
+    # only resize when the tokenizer really has a different size (a resize copies the embedding matrices)
+    if model.get_input_embeddings().num_embeddings != len(tokenizer):
+        model.resize_token_embeddings(len(tokenizer))
+    load_times['resize'] = time.time() - start
+
+    if args.save_safetensors and not os.path.isfile(safetensors_file):
+        from safetensors.torch import save_model
+        save_model(model, safetensors_file, metadata={'format': 'pt'})
+        logger.info("Saved the weights to {}, later runs load them memory-mapped.".format(safetensors_file))
+
+    logger.info("Load time: {}".format(format_load_times(load_times)))
+    profiler.add_section('model_load', load_times)
+    profiler.add_time('model_load', sum(load_times.values()))
 
     if model.config.decoder_start_token_id is None:
         raise ValueError("Make sure that `config.decoder_start_token_id` is correctly defined")
 
     return config, tokenizer, model
+
+
+def fast_load_model(safetensors_file, config, logger):
+    ''' build the model without random init and use the memory-mapped safetensors tensors as its weights '''
+
+    from safetensors.torch import load_file
+
+    with no_init_weights():
+        model = AutoModelForSeq2SeqLM.from_config(config)
+
+    state_dict = load_file(safetensors_file)
+
+    # tied weights (shared embeddings, lm head) are stored under one of their names only
+    model.tie_weights()
+    tied_names = {}
+    for name, tensor in model.state_dict(keep_vars=True).items():
+        tied_names.setdefault(id(tensor), []).append(name)
+    for names in tied_names.values():
+        stored = [name for name in names if name in state_dict]
+        if stored:
+            state_dict.update({name: state_dict[stored[0]] for name in names if name not in state_dict})
+
+    if 'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters:
+        # keep the mmap'd tensors as parameters instead of copying them into freshly allocated ones
+        missing, unexpected = model.load_state_dict(state_dict, strict=False, assign=True)
+    else:
+        missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    model.tie_weights()
+
+    if missing or unexpected:
+        logger.warning("{}: missing weights {}, unexpected weights {}".format(safetensors_file, missing, unexpected))
+
+    return model
+
+
+def format_load_times(load_times):
+    return ", ".join("{} {:.2f}s".format(stage, seconds) for stage, seconds in load_times.items())
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+###
+# Author: Bin Wang
+# -----
+# Copyright (c) 2022 National University of Singapore
+# -----
+
+
+import os
+import json
+import inspect
+
+import numpy as np
+import torch
+from tqdm.auto import tqdm
+
+from transformers.modeling_outputs import BaseModelOutput
+
+from scorer import IGNORE_INDEX, mean_log_probs, group_by_dialogue
+from score_cache import model_fingerprint, weight_file_stamp
+from profiler import NULL_PROFILER
+
+
+ENCODER_FILE = 'encoder.onnx'
+DECODER_FILE = 'decoder.onnx'
+EXPORT_FILE  = 'export.json'
+
+
+class EncoderGraph(torch.nn.Module):
+    # Encoder of the seq2seq model as a standalone graph
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.get_encoder()
+
+    def forward(self, input_ids, attention_mask):
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state
+
+
+class DecoderScoreGraph(torch.nn.Module):
+    # Decoder and LM head, reduced inside the graph to the mean log-probability of every row,
+    # so only one float per summary (not batch x length x vocab logits) leaves the session
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, encoder_hidden_states, attention_mask, decoder_input_ids, labels):
+        outputs = self.model(
+            encoder_outputs=BaseModelOutput(last_hidden_state=encoder_hidden_states),
+            attention_mask=attention_mask,
+            decoder_input_ids=decoder_input_ids,
+            decoder_attention_mask=torch.ones_like(decoder_input_ids),
+            use_cache=False,
+            return_dict=True,
+        )
+        return mean_log_probs(outputs.logits, labels)
+
+
+def export_fingerprint(model_name_or_path, config, model, file_digests=weight_file_stamp):
+    ''' model_fingerprint the graphs are exported from, None when it needs the torch model and that is not loaded '''
+
+    if model is None and not os.path.isdir(model_name_or_path):
+        return None
+
+    return model_fingerprint(model_name_or_path, config, model, file_digests)
+
+
+def is_exported(onnx_dir, fingerprint):
+    ''' onnx_dir holds both graphs, exported from the model with this export_fingerprint '''
+
+    if fingerprint is None or not all(os.path.exists(os.path.join(onnx_dir, name)) for name in (ENCODER_FILE, DECODER_FILE)):
+        return False
+    try:
+        with open(os.path.join(onnx_dir, EXPORT_FILE), 'r') as f:
+            return json.load(f).get('model') == fingerprint
+    except (OSError, ValueError):
+        return False
+
+
+def export_onnx(model, onnx_dir, fingerprint, opset_version=14):
+    ''' export the encoder and the scoring decoder of a seq2seq model (dynamic batch / lengths)
+
+        Scoring is teacher-forced, the whole summary is decoded in one call, so there is
+        no decoder-with-past graph: past key / values would never be reused. The export_fingerprint
+        of the model is written last (export.json), graphs of another model in onnx_dir are replaced.
+    '''
+
+    os.makedirs(onnx_dir, exist_ok=True)
+    if os.path.exists(os.path.join(onnx_dir, EXPORT_FILE)):
+        os.remove(os.path.join(onnx_dir, EXPORT_FILE))
+
+    # the exporter restores the train / eval mode of the wrappers (and so of the model) afterwards
+    model = model.eval()
+
+    # the TorchScript exporter, newer torch defaults to the dynamo one
+    export_kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+
+    # the second row is padded, otherwise the tracer may fold the (all ones) attention mask away
+    input_ids      = torch.full((2, 8), model.config.pad_token_id + 1, dtype=torch.long)
+    input_ids[1, -2:] = model.config.pad_token_id
+    attention_mask = input_ids.ne(model.config.pad_token_id).long()
+    labels         = torch.full((2, 5), model.config.pad_token_id + 1, dtype=torch.long)
+    with torch.no_grad():
+        encoder_hidden = EncoderGraph(model)(input_ids, attention_mask)
+
+    graphs = (
+        (ENCODER_FILE, EncoderGraph(model).eval(), (input_ids, attention_mask),
+         ['input_ids', 'attention_mask'], ['last_hidden_state'],
+         {'input_ids': {0: 'batch', 1: 'source'}, 'attention_mask': {0: 'batch', 1: 'source'},
+          'last_hidden_state': {0: 'batch', 1: 'source'}}),
+        (DECODER_FILE, DecoderScoreGraph(model).eval(), (encoder_hidden, attention_mask, labels, labels),
+         ['encoder_hidden_states', 'attention_mask', 'decoder_input_ids', 'labels'], ['mean_log_probs'],
+         {'encoder_hidden_states': {0: 'batch', 1: 'source'}, 'attention_mask': {0: 'batch', 1: 'source'},
+          'decoder_input_ids': {0: 'batch', 1: 'target'}, 'labels': {0: 'batch', 1: 'target'},
+          'mean_log_probs': {0: 'batch'}}),
+    )
+    for file_name, graph, inputs, input_names, output_names, dynamic_axes in graphs:
+        path = os.path.join(onnx_dir, file_name)
+        with torch.no_grad():
+            torch.onnx.export(graph, inputs, path + '.tmp', input_names=input_names, output_names=output_names,
+                              dynamic_axes=dynamic_axes, opset_version=opset_version, **export_kwargs)
+        os.replace(path + '.tmp', path)
+
+    path = os.path.join(onnx_dir, EXPORT_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'model': fingerprint, 'opset_version': opset_version}, f, indent=4)
+    os.replace(path + '.tmp', path)
+
+
+def shift_tokens_right(labels, pad_token_id, decoder_start_token_id):
+    ''' decoder inputs of teacher forcing (numpy version of the one in transformers) '''
+
+    decoder_input_ids        = np.full_like(labels, pad_token_id)
+    decoder_input_ids[:, 1:] = labels[:, :-1]
+    decoder_input_ids[:, 0]  = decoder_start_token_id
+    decoder_input_ids[decoder_input_ids == IGNORE_INDEX] = pad_token_id
+
+    return decoder_input_ids
+
+
+def pad_array(sequences, pad_value):
+    ''' right-pad a list of token id lists into one int64 array '''
+
+    padded = np.full((len(sequences), max(len(sequence) for sequence in sequences)), pad_value, dtype=np.int64)
+    for row, sequence in enumerate(sequences):
+        padded[row, :len(sequence)] = sequence
+
+    return padded
+
+
+class OnnxScorer():
+    # Scores summaries with the exported graphs on ONNX Runtime (CPU), no torch model needed
+    def __init__(self, onnx_dir, pad_token_id, decoder_start_token_id, num_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+
+        self.encoder = ort.InferenceSession(os.path.join(onnx_dir, ENCODER_FILE), options, providers=['CPUExecutionProvider'])
+        self.decoder = ort.InferenceSession(os.path.join(onnx_dir, DECODER_FILE), options, providers=['CPUExecutionProvider'])
+        self.pad_token_id           = pad_token_id
+        self.decoder_start_token_id = decoder_start_token_id
+
+    def score(self, input_ids, labels, sample_ids, batch_size, progress=True, profiler=NULL_PROFILER):
+        ''' mean log-probability of every summary, the encoder runs once per dialogue (as compute_grouped_sample_probs) '''
+
+        groups       = group_by_dialogue(input_ids, sample_ids)
+        sample_probs = [None] * len(input_ids)
+        for start in tqdm(range(0, len(groups), batch_size), disable=not progress):
+            group_batch = groups[start:start + batch_size]
+
+            with profiler.stage('collate'):
+                source_ids     = pad_array([input_ids[rows[0]] for rows in group_batch], self.pad_token_id)
+                attention_mask = (source_ids != self.pad_token_id).astype(np.int64)
+            profiler.count_tokens('source', attention_mask)
+            with profiler.stage('encoder'):
+                encoder_hidden = self.encoder.run(None, {'input_ids': source_ids, 'attention_mask': attention_mask})[0]
+
+            candidates = [(owner, index) for owner, rows in enumerate(group_batch) for index in rows]
+            candidates.sort(key=lambda candidate: len(labels[candidate[1]]), reverse=True)
+            for c_start in range(0, len(candidates), batch_size):
+                candidate_batch = candidates[c_start:c_start + batch_size]
+
+                with profiler.stage('collate'):
+                    owner      = np.array([owner for owner, _ in candidate_batch])
+                    target_ids = pad_array([labels[index] for _, index in candidate_batch], IGNORE_INDEX)
+                profiler.count('samples', len(candidate_batch))
+                profiler.count_tokens('target', target_ids != IGNORE_INDEX)
+
+                # the log-softmax reduction runs inside the decoder graph
+                with profiler.stage('decoder'):
+                    predict_probs = self.decoder.run(None, {
+                        'encoder_hidden_states': encoder_hidden[owner],
+                        'attention_mask'       : attention_mask[owner],
+                        'decoder_input_ids'    : shift_tokens_right(target_ids, self.pad_token_id, self.decoder_start_token_id),
+                        'labels'               : target_ids,
+                    })[0]
+
+                for (_, index), predict_prob in zip(candidate_batch, predict_probs.tolist()):
+                    sample_probs[index] = predict_prob
+
+        return sample_probs
+
+
+def parity_report(torch_probs, onnx_probs, tolerance):
+    ''' largest / mean difference between the PyTorch and ONNX Runtime log-probs of the same samples '''
+
+    abs_diff = np.abs(np.asarray(torch_probs, dtype=np.float64) - np.asarray(onnx_probs, dtype=np.float64))
+    max_diff = float(abs_diff.max()) if len(abs_diff) else 0.0
+
+    return {
+        'num_samples'  : len(abs_diff),
+        'max_abs_diff' : max_diff,
+        'mean_abs_diff': float(abs_diff.mean()) if len(abs_diff) else 0.0,
+        'tolerance'    : tolerance,
+        'passed'       : max_diff <= tolerance,
+    }
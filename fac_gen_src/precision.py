@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+###
+# Author: Bin Wang
+# -----
+# Copyright (c) 2022 National University of Singapore
+# -----
+
+
+import logging
+import contextlib
+
+import numpy as np
+import torch
+
+from metrics import aggregate_scores
+
+
+PRECISIONS = ('fp32', 'int8', 'bf16')
+
+
+def apply_precision(model, precision):
+    ''' model used for scoring: int8 quantizes the Linear layers (dynamic, CPU), bf16 / fp32 keep the weights '''
+
+    if precision == 'int8':
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    if precision == 'bf16' and not torch.ops.mkldnn._is_mkldnn_bf16_supported():
+        logging.warning("This CPU has no native bf16 support, bf16 autocast will likely be slower than fp32.")
+
+    return model
+
+
+def precision_context(precision, device):
+    ''' autocast for bf16, nothing for fp32 / int8 '''
+
+    if precision == 'bf16':
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def first_dialogue_rows(raw_datasets, num_dialogues):
+    ''' {split: rows} of the first num_dialogues dialogues (all their pos / neg summaries) '''
+
+    dialogue_ids = set(list(dict.fromkeys(raw_datasets['pos_data_dict']['id']))[:num_dialogues])
+
+    return {split: [index for index, sample_id in enumerate(raw_datasets[split]['id']) if sample_id in dialogue_ids]
+            for split in raw_datasets}
+
+
+def agreement_report(precision, reference, reduced, pos_ids, neg_ids, neg_labels, neg_markers, tie_policy):
+    ''' how far reduced-precision log-probs and FacEval scores are from fp32 on the same samples
+
+        reference / reduced: {'pos': [log-prob], 'neg': [log-prob], 'seconds': float}
+    '''
+
+    ref_probs = np.asarray(reference['pos'] + reference['neg'], dtype=np.float64)
+    low_probs = np.asarray(reduced['pos'] + reduced['neg'], dtype=np.float64)
+    abs_diff  = np.abs(ref_probs - low_probs)
+
+    # (pos, neg) pairs of the same dialogue that keep their order
+    pos_ids, neg_ids = np.asarray(pos_ids), np.asarray(neg_ids)
+    same_dialogue    = pos_ids[:, None] == neg_ids[None, :]
+    ref_order = np.sign(np.subtract.outer(np.asarray(reference['pos']), np.asarray(reference['neg'])))[same_dialogue]
+    low_order = np.sign(np.subtract.outer(np.asarray(reduced['pos']), np.asarray(reduced['neg'])))[same_dialogue]
+
+    scores = {}
+    for name, probs in (('fp32', reference), (precision, reduced)):
+        results = aggregate_scores(pos_ids, probs['pos'], neg_ids, neg_labels, probs['neg'], neg_markers,
+                                   tie_policy=tie_policy, num_bootstrap=0)
+        scores[name] = {neg_marker: result['score'] for neg_marker, result in results.items()}
+
+    return {
+        'precision'            : precision,
+        'num_dialogues'        : len(set(pos_ids.tolist())),
+        'num_samples'          : len(ref_probs),
+        'max_abs_diff'         : float(abs_diff.max()) if len(abs_diff) else 0.0,
+        'mean_abs_diff'        : float(abs_diff.mean()) if len(abs_diff) else 0.0,
+        'pearson'              : float(np.corrcoef(ref_probs, low_probs)[0, 1]) if len(ref_probs) > 1 else None,
+        'pair_order_agreement' : float(np.mean(ref_order == low_order)) if len(ref_order) else None,
+        'scores'               : {neg_marker: {'fp32'    : scores['fp32'][neg_marker],
+                                               precision : scores[precision][neg_marker],
+                                               'abs_diff': abs(scores['fp32'][neg_marker] - scores[precision][neg_marker])}
+                                  for neg_marker in neg_markers},
+        'seconds'              : {'fp32': reference['seconds'], precision: reduced['seconds']},
+        'speedup'              : reference['seconds'] / reduced['seconds'] if reduced['seconds'] > 0 else None,
+    }
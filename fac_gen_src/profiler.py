@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+###
+# Author: Bin Wang
+# -----
+# Copyright (c) 2022 National University of Singapore
+# -----
+
+
+import os
+import json
+import time
+import resource
+import contextlib
+
+import torch
+
+
+class Profiler():
+    # Per-stage wall time and counters of one scoring run (--profile). A disabled profiler
+    # (the default everywhere, NULL_PROFILER) does nothing, so the hot path pays no timing cost.
+
+    def __init__(self, enabled=False, device=None, name='profile'):
+        self.enabled  = enabled
+        self.name     = name
+        self.sync     = enabled and device is not None and torch.device(device).type == 'cuda'
+        self.start    = time.time()
+        self.stages   = {}
+        self.counters = {}
+        self.sections = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        ''' time the block under `name` (CUDA work is synchronized so it is counted in its own stage) '''
+
+        if not self.enabled:
+            yield
+            return
+
+        if self.sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync:
+                torch.cuda.synchronize()
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds, calls=1):
+        if not self.enabled:
+            return
+        stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+        stage['seconds'] += seconds
+        stage['calls']   += calls
+
+    def iterate(self, iterable, name):
+        ''' iterate with every `next` (e.g. dataloader collation) timed as one call of the stage '''
+
+        if not self.enabled:
+            yield from iterable
+            return
+
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def count_tokens(self, side, mask):
+        ''' real and padded positions of a (batch x length) 0 / 1 mask of source or target tokens '''
+
+        if self.enabled:
+            self.count(side + '_tokens', mask.sum())
+            self.count(side + '_positions', mask.numel() if hasattr(mask, 'numel') else mask.size)
+
+    def add_section(self, name, value):
+        if self.enabled:
+            self.sections[name] = value
+
+    def report(self):
+        ''' machine-readable summary: stages, counters, throughput, peak memory '''
+
+        wall_seconds  = time.time() - self.start
+        score_seconds = self.stages.get('score', {}).get('seconds', 0.0)
+        tokens        = self.counters.get('source_tokens', 0) + self.counters.get('target_tokens', 0)
+        positions     = self.counters.get('source_positions', 0) + self.counters.get('target_positions', 0)
+
+        report = {
+            'wall_seconds': wall_seconds,
+            'stages'      : {name: dict(stage, share=stage['seconds'] / wall_seconds if wall_seconds > 0 else None)
+                             for name, stage in sorted(self.stages.items(), key=lambda item: -item[1]['seconds'])},
+            'counters'    : dict(self.counters),
+            'throughput'  : {
+                'samples_per_sec': self.counters.get('samples', 0) / score_seconds if score_seconds > 0 else None,
+                'tokens_per_sec' : tokens / score_seconds if score_seconds > 0 else None,
+                'padding_ratio'  : 1 - tokens / positions if positions > 0 else None,
+            },
+            # ru_maxrss is in KB on Linux
+            'peak_rss_mb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+        if torch.cuda.is_available():
+            report['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+        report.update(self.sections)
+
+        return report
+
+    def write(self, output_dir):
+        ''' <output_dir>/<name>.json '''
+
+        path = os.path.join(output_dir, self.name + '.json')
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=4)
+
+        return path
+
+
+NULL_PROFILER = Profiler(enabled=False)
+
+
+@contextlib.contextmanager
+def torch_profile(profiler, output_dir, enabled=False, row_limit=25):
+    ''' run the block under torch.profiler, write a chrome trace and add the top operators to the report '''
+
+    if not enabled:
+        yield
+        return
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    with torch.profiler.profile(activities=activities, record_shapes=False) as torch_profiler:
+        yield
+
+    trace_file = os.path.join(output_dir, profiler.name + '_trace.json')
+    torch_profiler.export_chrome_trace(trace_file)
+
+    events = sorted(torch_profiler.key_averages(), key=lambda event: -event.self_cpu_time_total)[:row_limit]
+    profiler.add_section('torch_profiler', {
+        'trace_file': trace_file,
+        'top_ops'   : [{'name': event.key, 'calls': event.count,
+                        'self_cpu_ms': event.self_cpu_time_total / 1000, 'cpu_total_ms': event.cpu_time_total / 1000}
+                       for event in events],
+    })
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+###
+# Author: Bin Wang
+# -----
+# Copyright (c) 2022 National University of Singapore
+# -----
+
+
+import os
+import re
+import json
+import codecs
+import logging
+
+import numpy as np
+
+
+INDEX_VERSION = 1
+
+# skipped between the objects of a json array
+ARRAY_SEPARATOR = re.compile(r'[\s,\[\]]*')
+
+# bytes read at a time when scanning a json array
+CHUNK_SIZE = 1 << 20
+
+
+def iter_jsonl_rows(file_path):
+    ''' (byte offset, byte length, sample) of every non-empty line '''
+
+    offset = 0
+    with open(file_path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield offset, len(line), json.loads(line)
+            offset += len(line)
+
+
+def iter_json_array_rows(file_path, chunk_size=CHUNK_SIZE):
+    ''' (byte offset, byte length, sample) of every object of a json array, e.g. data/faceval_samples.json
+
+        The file is read in chunks of chunk_size bytes. The text after the last decoded object
+        is carried over, an object split across chunks is decoded once the next chunk is appended.
+    '''
+
+    decoder = json.JSONDecoder()
+    utf8    = codecs.getincrementaldecoder('utf-8')()
+
+    # text starts at byte text_offset of the file, (char_pos, byte_pos) is the last converted position
+    text, text_offset, is_ascii = '', 0, True
+    char_pos, byte_pos = 0, 0
+    def byte_offset(pos):
+        nonlocal char_pos, byte_pos
+        if is_ascii:
+            return text_offset + pos
+        byte_pos += len(text[char_pos:pos].encode('utf-8'))
+        char_pos  = pos
+        return text_offset + byte_pos
+
+    with open(file_path, 'rb') as f:
+        pos, at_end = 0, False
+        while True:
+            pos = ARRAY_SEPARATOR.match(text, pos).end()
+            if pos < len(text):
+                try:
+                    sample, end = decoder.raw_decode(text, pos)
+                except json.JSONDecodeError:
+                    if at_end:
+                        raise
+                else:
+                    start = byte_offset(pos)
+                    yield start, byte_offset(end) - start, sample
+                    pos = end
+                    continue
+            elif at_end:
+                return
+
+            # carry the undecoded text over to the next chunk
+            chunk       = f.read(chunk_size)
+            at_end      = not chunk
+            text_offset = byte_offset(pos)
+            text        = text[pos:] + utf8.decode(chunk, final=at_end)
+            is_ascii    = text.isascii()
+            pos, char_pos, byte_pos = 0, 0, 0
+
+
+def is_json_array(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read(1024).lstrip().startswith(b'[')
+
+
+def group_rows(keys):
+    ''' sorted distinct keys, and the rows of every key as slices order[starts[k]:starts[k + 1]] '''
+
+    names, codes = np.unique(np.asarray(keys, dtype=str), return_inverse=True)
+    codes        = codes.reshape(-1)
+    order        = np.argsort(codes, kind='stable')
+    starts       = np.searchsorted(codes[order], np.arange(len(names) + 1))
+
+    return names, order, starts
+
+
+class SampleIndex():
+    # Byte offset / length of every sample of a FacEval samples file (jsonl or json array),
+    # with label -> rows and id -> rows lookups. It is built with one pass over the file and
+    # persisted next to it (or in index_dir), so selecting error types, dialogues or ids reads
+    # only the selected rows. The index is rebuilt when the file size or mtime changes.
+
+    ARRAYS = ('offsets', 'lengths', 'label_names', 'label_order', 'label_starts', 'id_names', 'id_order', 'id_starts')
+
+    def __init__(self, file_path, arrays):
+        self.file_path = file_path
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @staticmethod
+    def index_path(file_path, index_dir=None):
+        directory = index_dir if index_dir is not None else os.path.dirname(os.path.abspath(file_path))
+        return os.path.join(directory, os.path.basename(file_path) + '.index.npz')
+
+    @staticmethod
+    def file_stamp(file_path):
+        stat = os.stat(file_path)
+        return np.array([INDEX_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    @classmethod
+    def load(cls, file_path, index_dir=None):
+        ''' the persisted index of the file, built (and saved) if it is missing or stale '''
+
+        path  = cls.index_path(file_path, index_dir)
+        stamp = cls.file_stamp(file_path)
+        if os.path.exists(path):
+            with np.load(path, allow_pickle=False) as saved:
+                if np.array_equal(saved['stamp'], stamp):
+                    return cls(file_path, {name: saved[name] for name in cls.ARRAYS})
+
+        index = cls.build(file_path)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                np.savez(f, stamp=stamp, **{name: getattr(index, name) for name in cls.ARRAYS})
+            os.replace(path + '.tmp', path)
+        except OSError as error:
+            logging.warning("Could not save the sample index to {}: {}".format(path, error))
+
+        return index
+
+    @classmethod
+    def build(cls, file_path):
+        ''' one pass over the file '''
+
+        logging.info("Indexing {}".format(file_path))
+        rows = iter_json_array_rows(file_path) if is_json_array(file_path) else iter_jsonl_rows(file_path)
+
+        offsets, lengths, labels, ids = [], [], [], []
+        for offset, length, sample in rows:
+            offsets.append(offset)
+            lengths.append(length)
+            labels.append(sample['label'])
+            ids.append(str(sample['id']))
+
+        arrays = {'offsets': np.array(offsets, dtype=np.int64), 'lengths': np.array(lengths, dtype=np.int64)}
+        arrays['label_names'], arrays['label_order'], arrays['label_starts'] = group_rows(labels)
+        arrays['id_names']   , arrays['id_order']   , arrays['id_starts']    = group_rows(ids)
+
+        return cls(file_path, arrays)
+
+    @property
+    def labels(self):
+        return self.label_names.tolist()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def lookup(self, names, order, starts, keys):
+        ''' rows of all the keys (keys that are not in the file select nothing) '''
+
+        keys  = np.asarray([str(key) for key in keys], dtype=str)
+        codes = np.searchsorted(names, keys).clip(max=max(len(names) - 1, 0))
+        found = codes[names[codes] == keys] if len(names) else codes[:0]
+
+        return np.concatenate([order[starts[code]:starts[code + 1]] for code in found] + [np.zeros(0, dtype=np.int64)])
+
+    def rows(self, labels=None, dialogue_ids=None):
+        ''' rows (in file order) with one of the labels and one of the dialogue ids, None selects all '''
+
+        selected = np.arange(len(self))
+        if labels is not None:
+            selected = np.intersect1d(selected, self.lookup(self.label_names, self.label_order, self.label_starts, labels))
+        if dialogue_ids is not None:
+            selected = np.intersect1d(selected, self.lookup(self.id_names, self.id_order, self.id_starts, dialogue_ids))
+
+        return selected
+
+    def read(self, rows):
+        ''' the samples of the rows, read straight from their byte offsets '''
+
+        samples = []
+        with open(self.file_path, 'rb') as f:
+            for offset, length in zip(self.offsets[rows].tolist(), self.lengths[rows].tolist()):
+                f.seek(offset)
+                samples.append(json.loads(f.read(length)))
+
+        return samples
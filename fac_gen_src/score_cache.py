@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+###
+# Author: Bin Wang
+# -----
+# Copyright (c) 2022 National University of Singapore
+# -----
+
+
+import os
+import json
+import sqlite3
+import hashlib
+import functools
+
+import torch
+
+
+# bump whenever the scoring kernel changes the numbers it produces
+SCORER_VERSION = 'logsumexp-mean-v1'
+
+WEIGHT_SUFFIXES = ('.bin', '.safetensors', '.ckpt', '.h5', '.msgpack', '.pt', '.pth')
+TORCH_SUFFIXES  = ('.bin', '.pt', '.pth')
+
+
+def sample_key(dialogue, summary):
+    ''' hash of one (dialogue, summary) pair '''
+
+    return hashlib.sha256((dialogue + '\x00' + summary).encode('utf-8')).hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer):
+    ''' hash of everything in the tokenizer that changes the token ids '''
+
+    sha = hashlib.sha256()
+    sha.update(type(tokenizer).__name__.encode('utf-8'))
+    if tokenizer.is_fast:
+        sha.update(tokenizer.backend_tokenizer.to_str().encode('utf-8'))
+    else:
+        sha.update(json.dumps(tokenizer.get_vocab(), sort_keys=True).encode('utf-8'))
+    sha.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True).encode('utf-8'))
+
+    return sha.hexdigest()
+
+
+def plain_file_sha(path):
+    ''' sha256 of a file '''
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def tensor_digests(tensors):
+    ''' sorted sha256 of every distinct tensor (shape and fp32 values)
+
+        Names are left out: a checkpoint and its safetensors conversion store the tied weights
+        under different names, but hold the same distinct tensors.
+    '''
+
+    digests = set()
+    for tensor in tensors:
+        tensor = tensor.detach().cpu().float().contiguous()
+        sha    = hashlib.sha256(json.dumps(list(tensor.shape)).encode('utf-8'))
+        sha.update(tensor.numpy().tobytes())
+        digests.add(sha.hexdigest())
+
+    return sorted(digests)
+
+
+def weight_file_stamp(path):
+    ''' cheap identity of a weight file: path, size and mtime (nothing is read) '''
+
+    stat = os.stat(path)
+
+    return ['{}:{}:{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)]
+
+
+def weight_file_digests(path):
+    ''' tensor_digests of a weight file, an identity that survives a format conversion
+
+        Opt-in (the whole file is read and hashed), memoised per process by path, size and mtime.
+    '''
+
+    stat = os.stat(path)
+
+    return _weight_file_digests(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=None)
+def _weight_file_digests(path, size, mtime_ns):
+    if path.endswith('.safetensors'):
+        from safetensors.torch import load_file
+        return tensor_digests(load_file(path).values())
+    if path.endswith(TORCH_SUFFIXES):
+        return tensor_digests(torch.load(path, map_location='cpu').values())
+
+    return [plain_file_sha(path)]
+
+
+class DigestMemo():
+    # weight_file_digests memoised in a json file (e.g. next to an incremental manifest),
+    # reused while the size and mtime of the weight file do not change
+
+    def __init__(self, memo_file):
+        self.memo_file = memo_file
+
+    def __call__(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+
+        memo = {}
+        if os.path.exists(self.memo_file):
+            with open(self.memo_file, 'r') as f:
+                memo = json.load(f)
+        entry = memo.get(path)
+        if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[2]
+
+        digests    = weight_file_digests(path)
+        memo[path] = [stat.st_size, stat.st_mtime_ns, digests]
+        tmp_file   = '{}.tmp{}'.format(self.memo_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(memo, f)
+        os.replace(tmp_file, self.memo_file)
+
+        return digests
+
+
+def loaded_weight_files(model_dir):
+    ''' the weight files of a model dir the model is loaded from: safetensors, else torch checkpoints, else any '''
+
+    names = sorted(name for name in os.listdir(model_dir) if name.endswith(WEIGHT_SUFFIXES))
+    for suffixes in (('.safetensors',), TORCH_SUFFIXES):
+        if any(name.endswith(suffixes) for name in names):
+            names = [name for name in names if name.endswith(suffixes)]
+            break
+
+    return [os.path.join(model_dir, name) for name in names]
+
+
+def weights_fingerprint(model_name_or_path, model, file_digests=weight_file_stamp):
+    ''' hash of the loaded weight files (their file_digests), or of the state dict
+
+        The default only stamps the files. With (memoised) weight_file_digests, converting the
+        weights to another format (e.g. --save_safetensors) keeps the fingerprint.
+    '''
+
+    weight_files = loaded_weight_files(model_name_or_path) if os.path.isdir(model_name_or_path) else []
+
+    if weight_files:
+        digests = sorted(set(digest for path in weight_files for digest in file_digests(path)))
+    elif model is None:
+        raise ValueError("Reusing log-probs needs the weight files of a local model directory or the loaded model")
+    else:
+        digests = tensor_digests(model.state_dict().values())
+
+    return hashlib.sha256(json.dumps(digests).encode('utf-8')).hexdigest()
+
+
+def config_dict(config):
+    ''' model config without where / with which version it was saved '''
+
+    config_dict = config.to_dict()
+    config_dict.pop('_name_or_path', None)
+    config_dict.pop('transformers_version', None)
+
+    return config_dict
+
+
+def model_fingerprint(model_name_or_path, config, model, file_digests=weight_file_stamp):
+    ''' hash of the model alone (config, weights and scorer version), e.g. to match an ONNX export with its model '''
+
+    fingerprint = {
+        'config' : config_dict(config),
+        'weights': weights_fingerprint(model_name_or_path, model, file_digests),
+        'scorer' : SCORER_VERSION,
+    }
+
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def scoring_namespace(args, config, tokenizer, model, file_digests=weight_file_stamp):
+    ''' hash of everything that changes the log-prob of a sample: model, tokenizer, preprocessing and scorer version '''
+
+    namespace = {
+        'config'           : config_dict(config),
+        'weights'          : weights_fingerprint(args.model_name_or_path, model, file_digests),
+        'tokenizer'        : tokenizer_fingerprint(tokenizer),
+        'max_source_length': args.max_source_length,
+        'max_target_length': args.max_target_length,
+        'source_prefix'    : args.source_prefix,
+        'scorer'           : SCORER_VERSION,
+    }
+    if args.precision != 'fp32':
+        namespace['precision'] = args.precision
+    if args.backend != 'torch':
+        namespace['backend'] = args.backend
+
+    return hashlib.sha256(json.dumps(namespace, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ScoreCache():
+    # Disk-backed cache of per-sample log-probabilities (sqlite)
+
+    def __init__(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(cache_dir, 'scores.sqlite'), timeout=60)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS scores "
+                          "(namespace TEXT, key TEXT, score REAL, PRIMARY KEY (namespace, key))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS weights "
+                          "(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, digests TEXT)")
+        self.conn.commit()
+        self.namespace = None
+
+    def set_namespace(self, args, config, tokenizer, model):
+        ''' key the cache by model (weight contents), tokenizer, preprocessing and scorer version '''
+
+        self.namespace = scoring_namespace(args, config, tokenizer, model, file_digests=self.file_digests)
+
+        return self.namespace
+
+    def file_digests(self, path):
+        ''' weight_file_digests of a file, reused while its size and mtime do not change '''
+
+        path  = os.path.abspath(path)
+        stat  = os.stat(path)
+        entry = self.conn.execute("SELECT size, mtime, digests FROM weights WHERE path = ?", (path,)).fetchone()
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return json.loads(entry[2])
+
+        digests = weight_file_digests(path)
+        self.conn.execute("INSERT OR REPLACE INTO weights VALUES (?, ?, ?, ?)",
+                          (path, stat.st_size, stat.st_mtime_ns, json.dumps(digests)))
+        self.conn.commit()
+
+        return digests
+
+    def get_many(self, keys):
+        ''' {key: score} for every key that is already cached '''
+
+        keys   = list(set(keys))
+        scores = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            query = "SELECT key, score FROM scores WHERE namespace = ? AND key IN ({})".format(",".join("?" * len(chunk)))
+            scores.update(self.conn.execute(query, [self.namespace] + chunk).fetchall())
+
+        return scores
+
+    def put_many(self, items):
+        ''' store (key, score) pairs '''
+
+        self.conn.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?)",
+                              [(self.namespace, key, score) for key, score in items])
+        self.conn.commit()
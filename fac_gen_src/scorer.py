@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+###
+# Author: Bin Wang
+# -----
+# Copyright (c) 2022 National University of Singapore
+# -----
+
+
+import torch
+from tqdm.auto import tqdm
+
+from transformers.modeling_outputs import BaseModelOutput
+
+from profiler import NULL_PROFILER
+
+
+IGNORE_INDEX = -100
+
+
+def mean_log_probs(output_logits, labels):
+    ''' mean log-probability of every row in the batch over its own non-padding labels
+
+        log p(y_t) = logit(y_t) - logsumexp(logits_t) is computed directly from the
+        logits, so no seq_len x vocab probability tensor is materialised and tiny
+        probabilities do not underflow to log(0). The reduction stays on device and
+        only one float per row is returned.
+    '''
+
+    target_mask   = labels.ne(IGNORE_INDEX)
+    target        = labels.masked_fill(~target_mask, 0).unsqueeze(-1)
+
+    output_logits = output_logits.float()
+    target_logits = output_logits.gather(dim=-1, index=target).squeeze(-1)
+    token_lprobs  = target_logits - torch.logsumexp(output_logits, dim=-1)
+    token_lprobs  = token_lprobs.masked_fill(~target_mask, 0.0)
+
+    return token_lprobs.sum(dim=-1) / target_mask.sum(dim=-1)
+
+
+def compute_sample_probs(model, dataloader, device=None, profiler=NULL_PROFILER):
+    ''' mean log-probability of the target summary for every sample in the dataloader
+
+        Batches may come in any order (e.g. sorted by length), each one carries the
+        `row_index` of its samples so the result is aligned with the dataset rows.
+    '''
+
+    encoder      = model.get_encoder()
+    sample_probs = [None] * len(dataloader.dataset)
+    for _, batch in enumerate(tqdm(profiler.iterate(dataloader, 'collate'), total=len(dataloader))):
+        row_index = batch.pop('row_index').tolist()
+        with profiler.stage('host_to_device'):
+            if device is not None:
+                batch = {key: value.to(device) for key, value in batch.items()}
+
+        profiler.count('samples', len(row_index))
+        profiler.count_tokens('source', batch['attention_mask'])
+        profiler.count_tokens('target', batch['labels'].ne(IGNORE_INDEX))
+
+        # the labels only feed mean_log_probs, passed to the model they would add an unused full-vocab loss
+        labels            = batch.pop('labels')
+        decoder_input_ids = batch.pop('decoder_input_ids', None)
+        if decoder_input_ids is None:
+            decoder_input_ids = model.prepare_decoder_input_ids_from_labels(labels=labels)
+
+        with torch.no_grad():
+            with profiler.stage('encoder'):
+                encoder_outputs = encoder(input_ids=batch['input_ids'], attention_mask=batch['attention_mask'], return_dict=True)
+            with profiler.stage('decoder'):
+                outputs = model(attention_mask=batch['attention_mask'], encoder_outputs=encoder_outputs,
+                                decoder_input_ids=decoder_input_ids)
+            with profiler.stage('log_softmax'):
+                batch_probs = mean_log_probs(outputs.logits, labels)
+
+        with profiler.stage('device_to_host'):
+            batch_probs = batch_probs.tolist()
+        for index, predict_prob in zip(row_index, batch_probs):
+            sample_probs[index] = predict_prob
+
+    return sample_probs
+
+
+def compute_grouped_sample_probs(model, input_ids, labels, sample_ids, batch_size, pad_token_id, device, progress=True,
+                                 profiler=NULL_PROFILER):
+    ''' mean log-probability of every summary, running the encoder only once per dialogue
+
+        Rows with the same sample id and the same (tokenized) dialogue form a group.
+        Up to `batch_size` dialogues are encoded together, then all of their candidate
+        summaries are decoded in length-sorted batches against the cached encoder output.
+    '''
+
+    groups       = group_by_dialogue(input_ids, sample_ids)
+    encoder      = model.get_encoder()
+    sample_probs = [None] * len(input_ids)
+    for start in tqdm(range(0, len(groups), batch_size), disable=not progress):
+        group_batch = groups[start:start + batch_size]
+
+        # encode each dialogue once
+        with profiler.stage('collate'):
+            source_ids     = pad_sequences([input_ids[rows[0]] for rows in group_batch], pad_token_id, device)
+            attention_mask = source_ids.ne(pad_token_id).long()
+        profiler.count_tokens('source', attention_mask)
+        with torch.no_grad(), profiler.stage('encoder'):
+            encoder_hidden = encoder(input_ids=source_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state
+
+        # decode every candidate summary of these dialogues
+        candidates = [(owner, index) for owner, rows in enumerate(group_batch) for index in rows]
+        candidates.sort(key=lambda candidate: len(labels[candidate[1]]), reverse=True)
+        for c_start in range(0, len(candidates), batch_size):
+            candidate_batch = candidates[c_start:c_start + batch_size]
+
+            with profiler.stage('collate'):
+                owner      = torch.tensor([owner for owner, _ in candidate_batch], device=device)
+                target_ids = pad_sequences([labels[index] for _, index in candidate_batch], IGNORE_INDEX, device)
+            profiler.count('samples', len(candidate_batch))
+            profiler.count_tokens('target', target_ids.ne(IGNORE_INDEX))
+
+            with torch.no_grad():
+                with profiler.stage('decoder'):
+                    outputs = model(
+                        encoder_outputs=BaseModelOutput(last_hidden_state=encoder_hidden.index_select(0, owner)),
+                        attention_mask=attention_mask.index_select(0, owner),
+                        decoder_input_ids=model.prepare_decoder_input_ids_from_labels(labels=target_ids),
+                    )
+                with profiler.stage('log_softmax'):
+                    batch_probs = mean_log_probs(outputs.logits, target_ids)
+
+            with profiler.stage('device_to_host'):
+                batch_probs = batch_probs.tolist()
+            for (_, index), predict_prob in zip(candidate_batch, batch_probs):
+                sample_probs[index] = predict_prob
+
+    return sample_probs
+
+
+def group_by_dialogue(input_ids, sample_ids):
+    ''' rows with the same sample id and tokenized dialogue, longest dialogue first '''
+
+    groups = {}
+    for index, (sample_id, source_ids) in enumerate(zip(sample_ids, input_ids)):
+        groups.setdefault((sample_id, tuple(source_ids)), []).append(index)
+
+    return sorted(groups.values(), key=lambda rows: len(input_ids[rows[0]]), reverse=True)
+
+
+def pad_sequences(sequences, pad_value, device):
+    ''' right-pad a list of token id lists into one LongTensor '''
+
+    max_length = max(len(sequence) for sequence in sequences)
+    padded     = torch.full((len(sequences), max_length), pad_value, dtype=torch.long)
+    for row, sequence in enumerate(sequences):
+        padded[row, :len(sequence)] = torch.tensor(sequence, dtype=torch.long)
+
+    return padded.to(device)
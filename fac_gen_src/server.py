@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+###
+# Author: Bin Wang
+# -----
+# Copyright (c) 2022 National University of Singapore
+# -----
+
+
+import os
+import sys
+import json
+import stat
+import time
+import queue
+import signal
+import socket
+import logging
+import ipaddress
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+import numpy as np
+import torch
+
+from accelerate import Accelerator
+
+from args import parse_args
+from model_loader import model_loader
+from scorer import compute_grouped_sample_probs
+from metrics import pairwise_ranking_scores
+from precision import apply_precision, precision_context
+from onnx_backend import OnnxScorer, export_fingerprint, is_exported, export_onnx
+
+
+# =  =  =  =  =  =  =  =  =  = Logging Setup =  =  =  =  =  =  =  =  =  =  =  =
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+
+
+class ScoreRequest():
+    # Samples of one HTTP request, waiting in the queue until the worker has scored them
+    def __init__(self, samples):
+        self.samples = samples
+        self.done    = threading.Event()
+        self.results = None
+        self.error   = None
+
+    @property
+    def num_candidates(self):
+        return sum(len(sample['summaries']) for sample in self.samples)
+
+
+class BatchScorer():
+    # Holds the model in memory. A single worker thread drains the request queue: requests that
+    # arrive while it is busy (or within max_batch_wait_ms of each other) are scored as one
+    # micro-batch, and every dialogue is encoded once for all of its candidate summaries.
+
+    def __init__(self, args, tokenizer, model, device):
+        self.args      = args
+        self.tokenizer = tokenizer
+        self.model     = model
+        self.device    = device
+        self.prefix    = args.source_prefix if args.source_prefix is not None else ""
+        self.requests  = queue.Queue()
+        self.worker    = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def score(self, samples):
+        ''' block until the samples of one request are scored '''
+
+        request = ScoreRequest(samples)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+
+        return request.results
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                results = self.score_batch([sample for request in batch for sample in request.samples])
+                for request in batch:
+                    request.results, results = results[:len(request.samples)], results[len(request.samples):]
+            except Exception as error:
+                logger.exception("Scoring a micro-batch of {} requests failed".format(len(batch)))
+                for request in batch:
+                    request.error = error
+            for request in batch:
+                request.done.set()
+
+    def next_batch(self):
+        ''' first waiting request, plus the ones that join within max_batch_wait_ms (up to max_batch_candidates) '''
+
+        batch          = [self.requests.get()]
+        num_candidates = batch[0].num_candidates
+        deadline       = time.time() + self.args.max_batch_wait_ms / 1000
+        while num_candidates < self.args.max_batch_candidates:
+            try:
+                request = self.requests.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                break
+            batch.append(request)
+            num_candidates += request.num_candidates
+
+        return batch
+
+    def score_batch(self, samples):
+        ''' log-likelihood, rank and (with a reference summary) pairwise score of every candidate '''
+
+        dialogues  = [self.prefix + sample['dialogue'] for sample in samples for _ in sample['summaries']]
+        summaries  = [summary for sample in samples for summary in sample['summaries']]
+        sample_ids = [index for index, sample in enumerate(samples) for _ in sample['summaries']]
+
+        input_ids = self.tokenizer(dialogues, max_length=self.args.max_source_length, truncation=True)['input_ids']
+        with self.tokenizer.as_target_tokenizer():
+            labels = self.tokenizer(summaries, max_length=self.args.max_target_length, truncation=True)['input_ids']
+
+        grouped_inputs = dict(input_ids=input_ids, labels=labels, sample_ids=sample_ids,
+                              batch_size=self.args.per_device_test_batch_size, progress=False)
+        if isinstance(self.model, OnnxScorer):
+            sample_probs = self.model.score(**grouped_inputs)
+        else:
+            with precision_context(self.args.precision, self.device):
+                sample_probs = compute_grouped_sample_probs(self.model, pad_token_id=self.tokenizer.pad_token_id,
+                                                            device=self.device, **grouped_inputs)
+
+        results, start = [], 0
+        for sample in samples:
+            log_probs = np.asarray(sample_probs[start:start + len(sample['summaries'])], dtype=np.float64)
+            start    += len(sample['summaries'])
+            results.append(candidate_scores(sample, log_probs, self.args.tie_policy))
+
+        return results
+
+
+def candidate_scores(sample, log_probs, tie_policy):
+    ''' response of one sample: ranks by log-likelihood (1 = most likely, ties share a rank),
+        and the FacEval pairwise score of the reference summary against the other candidates
+    '''
+
+    result = {
+        'log_probs': log_probs.tolist(),
+        'ranks'    : (1 + (log_probs[None, :] > log_probs[:, None]).sum(axis=1)).tolist(),
+    }
+    if 'id' in sample:
+        result['id'] = sample['id']
+
+    reference = sample.get('reference')
+    if reference is not None:
+        others = np.delete(log_probs, reference)
+        ranked = pairwise_ranking_scores([0], log_probs[[reference]], [0] * len(others), others, tie_policy)
+        result['pairwise'] = {
+            'score'    : float(ranked['scores'][0]) if len(ranked['scores']) else None,
+            'num_pairs': int(ranked['pairs'].sum()),
+            'num_ties' : int(ranked['ties'].sum()),
+        }
+
+    return result
+
+
+def check_samples(body):
+    ''' samples of a request body, ValueError if it is malformed '''
+
+    samples = body.get('samples') if isinstance(body, dict) else None
+    if not isinstance(samples, list) or not samples:
+        raise ValueError("The request needs a non-empty list `samples`")
+
+    for sample in samples:
+        if not isinstance(sample, dict) or not isinstance(sample.get('dialogue'), str):
+            raise ValueError("Every sample needs a string `dialogue`")
+        summaries = sample.get('summaries')
+        if not isinstance(summaries, list) or not summaries or not all(isinstance(summary, str) for summary in summaries):
+            raise ValueError("Every sample needs a non-empty list of string `summaries`")
+        reference = sample.get('reference')
+        if reference is not None and (not isinstance(reference, int) or not 0 <= reference < len(summaries)):
+            raise ValueError("`reference` must be the index of one of the `summaries`")
+
+    return samples
+
+
+class ScoreHandler(BaseHTTPRequestHandler):
+    # POST /score {"samples": [{"dialogue": str, "summaries": [str], "reference": int (optional)}]}
+    # GET /health
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok', 'model': self.server.model_name})
+        else:
+            self.send_json(404, {'error': "Unknown path {}".format(self.path)})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self.send_json(404, {'error': "Unknown path {}".format(self.path)})
+            return
+
+        try:
+            body    = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'null')
+            samples = check_samples(body)
+        except ValueError as error:
+            self.send_json(400, {'error': str(error)})
+            return
+
+        try:
+            results = self.server.scorer.score(samples)
+        except Exception as error:
+            self.send_json(500, {'error': str(error)})
+            return
+
+        self.send_json(200, {'results': results})
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # a Unix socket client has no (host, port)
+        return self.client_address[0] if self.client_address else self.server.server_address
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, None
+
+
+def is_socket(path):
+    return os.path.lexists(path) and stat.S_ISSOCK(os.lstat(path).st_mode)
+
+
+def remove_stale_socket(path):
+    ''' remove the socket file a previous server left behind, refuse anything else at the path '''
+
+    if not os.path.lexists(path):
+        return
+    if not is_socket(path):
+        raise ValueError("`--socket_path {}` exists and is not a socket, refusing to remove it".format(path))
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(path)
+            return
+    raise ValueError("`--socket_path {}` is in use by a running server".format(path))
+
+
+def make_server(args, scorer, model_name):
+    ''' threaded HTTP server on a Unix socket or a loopback TCP address (never reachable from outside) '''
+
+    if args.socket_path is not None:
+        remove_stale_socket(args.socket_path)
+        server = UnixHTTPServer(args.socket_path, ScoreHandler)
+        os.chmod(args.socket_path, 0o600)
+    else:
+        if not ipaddress.ip_address(socket.gethostbyname(args.host)).is_loopback:
+            raise ValueError("The scoring server only listens on localhost, got `--host {}`".format(args.host))
+        server = ThreadingHTTPServer((args.host, args.port), ScoreHandler)
+
+    server.scorer     = scorer
+    server.model_name = model_name
+
+    return server
+
+
+def onnx_dir_of(args):
+    return args.onnx_dir if args.onnx_dir is not None else os.path.join(args.output_dir, 'onnx')
+
+
+def load_scoring_model(args, accelerator, config, tokenizer, model, model_id=None):
+    ''' model used by the worker: ONNX Runtime sessions, or the torch model in the requested precision
+
+        model_id is the export_fingerprint of the model when already computed (see main).
+    '''
+
+    if args.backend == 'onnx':
+        # without the torch model the export already matched it, an export of another model is replaced
+        onnx_dir = onnx_dir_of(args)
+        if model is not None:
+            if model_id is None:
+                model_id = export_fingerprint(args.model_name_or_path, config, model)
+            if not is_exported(onnx_dir, model_id):
+                logger.info("Exporting the model to ONNX in {}".format(onnx_dir))
+                export_onnx(model, onnx_dir, model_id)
+        return OnnxScorer(onnx_dir, tokenizer.pad_token_id, config.decoder_start_token_id, torch.get_num_threads())
+
+    return apply_precision(model, args.precision)
+
+
+# = = = = = = = = = = = = = Main Process = = = = = = = = = = = = = = = = = =
+def main():
+    args = parse_args(require_neg_marker=False)
+
+    if args.backend == 'onnx' and args.onnx_dir is None and args.output_dir is None:
+        raise ValueError("Make sure that `--onnx_dir` or `--output_dir` is defined for the ONNX backend")
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    accelerator = Accelerator(cpu=not torch.cuda.is_available())
+
+    # the ONNX backend only needs the torch model to export it, not when the export of this very model exists
+    model_ids = {}
+    def needs_torch_model(config, tokenizer):
+        if args.backend == 'torch':
+            return True
+        model_ids['export'] = export_fingerprint(args.model_name_or_path, config, None)
+        return not is_exported(onnx_dir_of(args), model_ids['export'])
+    config, tokenizer, model = model_loader(accelerator, logger, args, load_model=needs_torch_model)
+    if model is not None:
+        model = accelerator.prepare(model)
+        model.eval()
+        model = accelerator.unwrap_model(model)
+
+    scoring_model = load_scoring_model(args, accelerator, config, tokenizer, model, model_ids.get('export'))
+    scorer        = BatchScorer(args, tokenizer, scoring_model, accelerator.device)
+    server        = make_server(args, scorer, args.model_name_or_path)
+    logger.info("Scoring server listening on {}".format(
+        args.socket_path if args.socket_path is not None else "http://{}:{}".format(*server.server_address[:2])))
+
+    # SIGTERM (e.g. from a process manager) shuts down like Ctrl-C, so the socket file is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket_path is not None and is_socket(args.socket_path):
+            os.remove(args.socket_path)
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# Main Process
+if __name__ == "__main__":
+    main()
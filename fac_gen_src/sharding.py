@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+###
+# Author: Bin Wang
+# -----
+# Copyright (c) 2022 National University of Singapore
+# -----
+
+
+import os
+import json
+import hashlib
+
+
+SPLITS = ('pos_data_dict', 'neg_data_dict')
+
+
+def shard_of(sample_id, num_shards):
+    ''' stable shard of a dialogue id (the same in every process and every run) '''
+
+    return int(hashlib.sha1(str(sample_id).encode('utf-8')).hexdigest()[:8], 16) % num_shards
+
+
+def shard_rows(sample_ids, shard_id, num_shards):
+    ''' rows whose dialogue belongs to the shard, all pos / neg summaries of a dialogue stay together '''
+
+    return [index for index, sample_id in enumerate(sample_ids) if shard_of(sample_id, num_shards) == shard_id]
+
+
+def file_stamp(path):
+    ''' (path, size, mtime) of a file, or of every file in a directory (e.g. a columnar sample set) '''
+
+    paths = sorted(os.path.join(path, name) for name in os.listdir(path)) if os.path.isdir(path) else [path]
+
+    return [[os.path.abspath(file_path), os.stat(file_path).st_size, os.stat(file_path).st_mtime_ns] for file_path in paths]
+
+
+def run_fingerprint(args, namespace, num_shards):
+    ''' hash of everything the partial results depend on: scoring namespace, sample set, selection and sharding '''
+
+    run = {
+        'namespace'   : namespace,
+        'samples'     : file_stamp(args.load_file),
+        'columns'     : [args.text_column, args.summary_column],
+        'neg_markers' : args.neg_markers,
+        'dialogue_ids': args.dialogue_ids,
+        'num_shards'  : num_shards,
+    }
+
+    return hashlib.sha256(json.dumps(run, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def partial_path(output_dir, shard_id, num_shards):
+    return os.path.join(output_dir, 'partials', 'shard{}-of-{}.json'.format(shard_id, num_shards))
+
+
+def write_partial(output_dir, shard_id, num_shards, num_rows, rows, columns, fingerprint):
+    ''' scores of one shard, keyed by the row index in the full dataset
+
+        rows       : {split: [global row index]}
+        columns    : {split: {column: [value per row]}}, e.g. id / marker / prob
+        fingerprint: run_fingerprint of the run that scored them
+    '''
+
+    path = partial_path(output_dir, shard_id, num_shards)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    partial = {
+        'shard_id'   : shard_id,
+        'num_shards' : num_shards,
+        'fingerprint': fingerprint,
+        'num_rows'   : num_rows,
+        'rows'       : rows,
+        'columns'    : columns,
+    }
+    with open(path + '.tmp', 'w') as f:
+        json.dump(partial, f)
+    os.replace(path + '.tmp', path)
+
+    return path
+
+
+def read_fingerprint(path):
+    ''' run fingerprint of a partial result file, None if it is unreadable or has none '''
+
+    try:
+        with open(path, 'r') as f:
+            return json.load(f).get('fingerprint')
+    except (OSError, ValueError):
+        return None
+
+
+def clear_stale_partials(output_dir, fingerprint):
+    ''' delete the partial results of other runs (model, sample set, error types or number of shards) '''
+
+    directory = os.path.dirname(partial_path(output_dir, 0, 1))
+    if not os.path.isdir(directory):
+        return []
+
+    stale = [name for name in sorted(os.listdir(directory))
+             if name.endswith('.json') and read_fingerprint(os.path.join(directory, name)) != fingerprint]
+    for name in stale:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+
+    return stale
+
+
+def missing_partials(output_dir, num_shards, fingerprint):
+    ''' shards whose partial results of this run are not written yet '''
+
+    return [shard_id for shard_id in range(num_shards)
+            if read_fingerprint(partial_path(output_dir, shard_id, num_shards)) != fingerprint]
+
+
+def merge_partials(output_dir, num_shards, fingerprint):
+    ''' {split: {column: [value per row]}} of the full dataset, rebuilt in the original row order '''
+
+    merged, num_rows = {}, None
+    for shard_id in range(num_shards):
+        with open(partial_path(output_dir, shard_id, num_shards), 'r') as f:
+            partial = json.load(f)
+
+        if partial.get('fingerprint') != fingerprint:
+            raise ValueError("Partial results of shard {} come from another run (model, sample set, error types "
+                             "or number of shards), score the shard again".format(shard_id))
+        if num_rows is None:
+            num_rows = partial['num_rows']
+            merged   = {split: {column: [None] * num_rows[split] for column in partial['columns'][split]}
+                        for split in SPLITS}
+        elif partial['num_rows'] != num_rows:
+            raise ValueError("Partial results of shard {} come from a different dataset ({} vs {} rows)".format(
+                shard_id, partial['num_rows'], num_rows))
+
+        for split in SPLITS:
+            for column, values in partial['columns'][split].items():
+                for index, value in zip(partial['rows'][split], values):
+                    merged[split][column][index] = value
+
+    for split in SPLITS:
+        for column, values in merged[split].items():
+            if any(value is None for value in values):
+                raise ValueError("Rows of {} are missing from the partial results in {}".format(split, output_dir))
+
+    return merged
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+###
+# Author: Bin Wang
+# -----
+# Copyright (c) 2022 National University of Singapore
+# -----
+
+
+import os
+import json
+import sqlite3
+import hashlib
+
+import numpy as np
+import pyarrow as pa
+import datasets
+from filelock import FileLock
+
+from scorer import IGNORE_INDEX
+from score_cache import tokenizer_fingerprint
+
+
+def text_key(text):
+    ''' hash of one text '''
+
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def list_array(values, lengths):
+    ''' arrow list column from flat values and the length of every row (no per-element python) '''
+
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int32)
+    np.cumsum(lengths, out=offsets[1:])
+
+    return pa.ListArray.from_arrays(pa.array(offsets), pa.array(values))
+
+
+def pad_rows(values, lengths, max_length, pad_value):
+    ''' (rows x max_length) matrix of the rows right-padded with pad_value, and the padding mask '''
+
+    mask   = np.arange(max_length)[None, :] < lengths[:, None]
+    padded = np.full((len(lengths), max_length), pad_value, dtype=values.dtype)
+    padded[mask] = values
+
+    return padded, mask
+
+
+class TokenStore():
+    # Persistent token ids of texts, keyed by tokenizer fingerprint, truncation and text hash.
+    # The ids of all texts are appended to one flat int32 file that is memory mapped on read,
+    # an sqlite index holds the (offset, length) of every text.
+
+    def __init__(self, store_dir, tokenizer):
+        os.makedirs(store_dir, exist_ok=True)
+        self.ids_file    = os.path.join(store_dir, 'token_ids.int32')
+        self.lock        = FileLock(os.path.join(store_dir, 'token_ids.lock'))
+        self.conn        = sqlite3.connect(os.path.join(store_dir, 'index.sqlite'), timeout=60)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS tokens "
+                          "(namespace TEXT, key TEXT, offset INTEGER, length INTEGER, PRIMARY KEY (namespace, key))")
+        self.conn.commit()
+        self.tokenizer   = tokenizer
+        self.fingerprint = tokenizer_fingerprint(tokenizer)
+
+    def namespace(self, side, max_length):
+        ''' source and target texts are tokenized differently, as is every truncation length '''
+
+        return hashlib.sha256(json.dumps([self.fingerprint, side, max_length]).encode('utf-8')).hexdigest()
+
+    def lookup(self, namespace, keys):
+        ''' {key: (offset, length)} for every key that is already stored '''
+
+        keys  = list(set(keys))
+        spans = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            query = "SELECT key, offset, length FROM tokens WHERE namespace = ? AND key IN ({})".format(",".join("?" * len(chunk)))
+            spans.update((key, (offset, length)) for key, offset, length in self.conn.execute(query, [namespace] + chunk))
+
+        return spans
+
+    def tokenize(self, texts, side, max_length):
+        ''' truncated, unpadded token ids of the texts '''
+
+        input_ids = []
+        for start in range(0, len(texts), 1000):
+            if side == 'target':
+                with self.tokenizer.as_target_tokenizer():
+                    encoded = self.tokenizer(texts[start:start + 1000], max_length=max_length, truncation=True)
+            else:
+                encoded = self.tokenizer(texts[start:start + 1000], max_length=max_length, truncation=True)
+            input_ids.extend(encoded['input_ids'])
+
+        return input_ids
+
+    def token_ids(self, texts, side, max_length):
+        ''' flat token ids of the texts (read from the memory-mapped store) and the length of each
+
+            Texts that are not in the store yet are tokenized once and appended, under a file
+            lock so that several processes can share one store.
+        '''
+
+        namespace = self.namespace(side, max_length)
+        keys      = [text_key(text) for text in texts]
+        spans     = self.lookup(namespace, keys)
+
+        missing = {key: text for key, text in zip(keys, texts) if key not in spans}
+        if missing:
+            with self.lock:
+                spans.update(self.lookup(namespace, missing))
+                missing = {key: text for key, text in missing.items() if key not in spans}
+                if missing:
+                    spans.update(self.append(namespace, missing, side, max_length))
+
+        if not keys:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)
+
+        starts  = np.array([spans[key][0] for key in keys], dtype=np.int64)
+        lengths = np.array([spans[key][1] for key in keys], dtype=np.int64)
+
+        # position of every token of every text in the flat file
+        row_starts = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        positions  = row_starts + np.arange(int(lengths.sum()), dtype=np.int64)
+
+        return np.array(np.memmap(self.ids_file, dtype=np.int32, mode='r')[positions]), lengths
+
+    def append(self, namespace, texts, side, max_length):
+        ''' tokenize {key: text}, append the ids to the flat file and index them '''
+
+        input_ids = self.tokenize(list(texts.values()), side, max_length)
+        lengths   = [len(ids) for ids in input_ids]
+        offset    = os.path.getsize(self.ids_file) // 4 if os.path.exists(self.ids_file) else 0
+
+        with open(self.ids_file, 'ab') as f:
+            f.write(np.concatenate([np.asarray(ids, dtype=np.int32) for ids in input_ids]).tobytes())
+
+        spans = {}
+        for key, length in zip(texts, lengths):
+            spans[key] = (offset, length)
+            offset    += length
+
+        self.conn.executemany("INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)",
+                              [(namespace, key, start, length) for key, (start, length) in spans.items()])
+        self.conn.commit()
+
+        return spans
+
+    def processed_dataset(self, texts, summaries, prefix, args, pad_token_id):
+        ''' the columns of data_processor's tokenized dataset, built from the store '''
+
+        source_ids, source_lengths = self.token_ids([prefix + text for text in texts], 'source', args.max_source_length)
+        target_ids, target_lengths = self.token_ids(summaries, 'target', args.max_target_length)
+
+        if args.pad_to_max_length:
+            source_ids, source_mask = pad_rows(source_ids, source_lengths, args.max_source_length, pad_token_id)
+            target_ids, _           = pad_rows(target_ids, target_lengths, args.max_target_length, pad_token_id)
+            if args.ignore_pad_token_for_loss:
+                target_ids = np.where(target_ids == pad_token_id, IGNORE_INDEX, target_ids)
+
+            attention_mask = source_mask.astype(np.int8).reshape(-1)
+            source_ids     = source_ids.reshape(-1)
+            target_ids     = target_ids.reshape(-1)
+            source_lengths = np.full(len(source_lengths), args.max_source_length)
+            target_lengths = np.full(len(target_lengths), args.max_target_length)
+        else:
+            attention_mask = np.ones(len(source_ids), dtype=np.int8)
+
+        table = pa.table({
+            'input_ids'     : list_array(source_ids, source_lengths),
+            'attention_mask': list_array(attention_mask, source_lengths),
+            'labels'        : list_array(target_ids, target_lengths),
+            'row_index'     : pa.array(np.arange(len(source_lengths), dtype=np.int64)),
+        })
+
+        return datasets.Dataset(table)
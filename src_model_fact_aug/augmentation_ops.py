@@ -7,11 +7,26 @@
 # -----
 
 
+import re
 import random
+import functools
+import itertools
 import spacy
 
 import logging
 
+# spaCy pipelines shared by every operator of this process, loaded on first use
+_SPACY_PIPELINES = {}
+
+
+def load_spacy(name="en_core_web_sm"):
+    ''' load a spaCy pipeline once per process '''
+
+    if name not in _SPACY_PIPELINES:
+        _SPACY_PIPELINES[name] = spacy.load(name)
+    return _SPACY_PIPELINES[name]
+
+
 def align_ws(old_token, new_token):
     # Align trailing whitespaces between tokens
     if old_token[-1] == new_token[-1] == " ":
@@ -24,18 +39,150 @@ def align_ws(old_token, new_token):
         return new_token
 
 
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# components not needed by any operator
+SPACY_DISABLE = ["tagger", "lemmatizer"]
+
+
+def dialogue_speakers(dialogue):
+    ''' distinct speakers of a dialogue ("speaker: utterance" per line) '''
+
+    return sorted(set(line.split(':')[0] for line in dialogue.split('\n')))
+
+
+def analyse_samples(samples, batch_size=64, n_process=1):
+    ''' parse every dialogue and summary once and keep what the operators need
+
+        The analysis is shared by all operators and all repetitions, so spaCy runs
+        once per text instead of once per (operator, pass).
+    '''
+
+    return list(iter_analyses(samples, batch_size, n_process))
+
+
+def iter_analyses(samples, batch_size=64, n_process=1):
+    ''' lazily analyse samples with one nlp.pipe stream over (dialogue, summary, dialogue, ...) '''
+
+    samples, texts = itertools.tee(samples)
+    texts = (text for sample in texts for text in (sample['dialogue'], sample['summary']))
+    docs  = load_spacy().pipe(texts, disable=SPACY_DISABLE, batch_size=batch_size, n_process=n_process)
+
+    for sample in samples:
+        dialogue_doc = next(docs)
+        summary_doc  = next(docs)
+        yield analyse_docs(sample, dialogue_doc, summary_doc)
+
+
+def analyse_docs(sample, dialogue_doc, summary_doc):
+    ''' picklable summary of the parsed dialogue / summary of one sample '''
+
+    return {
+        'speakers'      : dialogue_speakers(sample['dialogue']),
+        'dialogue_ents' : [(ent.text, ent.label_) for ent in dialogue_doc.ents],
+        'summary_ents'  : [(ent.text, ent.label_) for ent in summary_doc.ents],
+        'summary_tokens': [(token.text, token.text_with_ws) for token in summary_doc],
+    }
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 class Transformation():
     # Base class for all data transformations
 
-    def __init__(self):
-        # Spacy toolkit used for all NLP-related substeps
-        self.spacy = spacy.load("en_core_web_sm")
+    # number of swaps applied together by one transformation
+    max_swaps = 1
+
+    @property
+    def spacy(self):
+        # Spacy toolkit used for all NLP-related substeps (shared, loaded lazily)
+        return load_spacy()
+
+    def reset(self):
+        # Reset per-example state, called before every transformation
+        pass
 
-    def transform(self, example):
+    def analyse(self, example, analysis=None):
+        # Parse the example unless its analysis was pre-computed
+        if analysis is None:
+            analysis = analyse_samples([example])[0]
+        return analysis
+
+    def transform(self, example, analysis=None):
         # Function applies transformation on passed example
         pass
 
+    def candidates(self, example, analysis=None):
+        # All distinct edits the transformation can make to the passed example
+        return []
+
+    def apply(self, example, analysis, candidate):
+        # Function applies one edit returned by candidates, None if nothing changes
+        pass
+
+    def new_example(self, example, new_summary):
+        # Copy of the example with the corrupted summary
+        if not new_summary or new_summary == example['summary']:
+            return None
+        return {'id': example["id"], 'dialogue': example["dialogue"], 'summary': new_summary}
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+@functools.lru_cache(maxsize=4096)
+def compile_swaps(swaps):
+    ''' one regex alternation over both sides of every (str1, str2) swap, longest first
+
+        Matches only whole words (not preceded / followed by a word character), the
+        mapping sends every matched span to its counterpart.
+    '''
+
+    mapping = {}
+    for str1, str2 in swaps:
+        mapping.setdefault(str1, str2)
+    for str1, str2 in swaps:
+        mapping.setdefault(str2, str1)
+
+    alternation = '|'.join(re.escape(span) for span in sorted(mapping, key=len, reverse=True))
+    return re.compile(r'(?<!\w)(?:' + alternation + r')(?!\w)'), mapping
+
+
+def apply_swaps(text, swap_dict):
+    ''' exchange both sides of every swap in a single pass over text '''
+
+    swaps = tuple((str1, str2) for str1, str2 in swap_dict.items() if str1 and str2 and str1 != str2)
+    if not swaps:
+        return text
+
+    pattern, mapping = compile_swaps(swaps)
+    return pattern.sub(lambda match: mapping[match.group(0)], text)
+
+
+def first_swaps(swap_dict, max_swaps):
+    ''' the first max_swaps entries of a swap dict '''
+
+    return dict(itertools.islice(swap_dict.items(), max_swaps))
+
+
+def swap_combinations(pairs, max_swaps):
+    ''' candidate edits of a swap operator: tuples of max_swaps pairs without a common string
+
+        As in transform, fewer swaps are combined when the pairs do not allow max_swaps of them.
+    '''
+
+    def disjoint(start, used, size):
+        if size == 0:
+            yield ()
+            return
+        for index in range(start, len(pairs)):
+            if pairs[index][0] in used or pairs[index][1] in used:
+                continue
+            for rest in disjoint(index + 1, used | set(pairs[index]), size - 1):
+                yield (pairs[index],) + rest
+
+    for size in range(min(max_swaps, len(pairs)), 0, -1):
+        combinations = list(disjoint(0, frozenset(), size))
+        if combinations:
+            return combinations
+    return []
+
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 class SpeakerSwap(Transformation):
@@ -43,10 +190,12 @@ class SpeakerSwap(Transformation):
     def __init__(self):
         super().__init__()
     
-    def transform(self, example):
+    def transform(self, example, analysis=None):
         ''' transform one sample '''
 
-        new_summary, num_swap = self.__swap_speakers(example['dialogue'], example['summary'])
+        speakers = analysis['speakers'] if analysis is not None else dialogue_speakers(example['dialogue'])
+
+        new_summary, num_swap = self.__swap_speakers(speakers, example['summary'])
 
         if new_summary:
             new_example = { 'id': example["id"], 
@@ -57,14 +206,23 @@ class SpeakerSwap(Transformation):
         else:
             return None, num_swap
 
-    def __swap_speakers(self, dialogue_ori, summary):
-        ''' swap speaker '''
+    def candidates(self, example, analysis=None):
+        ''' speaker pairs with at least one of them mentioned in the summary, up to max_swaps of them together '''
 
-        ori_sum = summary
+        speakers = analysis['speakers'] if analysis is not None else dialogue_speakers(example['dialogue'])
+        summary  = example['summary']
+
+        return swap_combinations([(sp1, sp2) for sp1, sp2 in itertools.combinations(speakers, 2) if sp1 in summary or sp2 in summary],
+                                 self.max_swaps)
+
+    def apply(self, example, analysis, candidate):
+        return self.new_example(example, apply_swaps(example['summary'], dict(candidate)))
+
+    def __swap_speakers(self, speakers, summary):
+        ''' swap speaker '''
 
-        dialogue_ori_li = dialogue_ori.split('\n')
-        speakers        = [dialogue.split(':')[0] for dialogue in dialogue_ori_li]
-        speakers        = list(set(speakers))
+        ori_sum  = summary
+        speakers = list(speakers)
 
         random.shuffle(speakers)
 
@@ -77,11 +235,7 @@ class SpeakerSwap(Transformation):
             else:
                 continue
 
-        for sp1, sp2 in swap_dict.items():
-            summary = summary.replace(sp1, 'tmker')
-            summary = summary.replace(sp2, sp1)
-            summary = summary.replace('tmker', sp2)
-            break
+        summary = apply_swaps(summary, first_swaps(swap_dict, self.max_swaps))
 
         if len(swap_dict) == 0:
             return None, 0
@@ -99,12 +253,12 @@ class NERSwap(Transformation):
         super().__init__()
         self.categories = ()
 
-    def transform(self, example):
+    def transform(self, example, analysis=None):
 
-        dialogue = example['dialogue']
+        analysis = self.analyse(example, analysis)
         summary  = example['summary']
 
-        new_summary, num_swap = self.__swap_entities(dialogue, summary)
+        new_summary, num_swap = self.__swap_entities(analysis, summary)
 
         if new_summary:
             new_example = { 'id': example["id"], 
@@ -115,19 +269,29 @@ class NERSwap(Transformation):
         else:
             return None, 0
 
-    def __swap_entities(self, text, summary):
+    def candidates(self, example, analysis=None):
+        ''' (summary entity, dialogue entity) pairs of the same categories, up to max_swaps of them together '''
 
-        ori_sum = summary
+        summary_ents, text_ents = self.__swappable_entities(self.analyse(example, analysis))
+
+        return swap_combinations(list(itertools.product(dict.fromkeys(summary_ents), dict.fromkeys(text_ents))), self.max_swaps)
+
+    def apply(self, example, analysis, candidate):
+        return self.new_example(example, apply_swaps(example['summary'], dict(candidate)))
+
+    def __swappable_entities(self, analysis):
+        speakers = analysis['speakers']
+
+        summary_ents = [text for text, label in analysis['summary_ents'] if label in self.categories and text not in speakers]
+        text_ents    = [text for text, label in analysis['dialogue_ents'] if label in self.categories and text not in speakers and text not in summary_ents]
 
-        dialogue_ori_li = text.split('\n')
-        speakers        = [dialogue.split(':')[0] for dialogue in dialogue_ori_li]
-        speakers        = list(set(speakers))
+        return summary_ents, text_ents
 
-        summary_sp   = self.spacy(summary, disable=["tagger", 'lemmatizer'])
-        summary_ents = [ent.text for ent in summary_sp.ents if ent.label_ in self.categories and ent.text not in speakers]
+    def __swap_entities(self, analysis, summary):
 
-        text      = self.spacy(text, disable=["tagger", 'lemmatizer'])
-        text_ents = [ent.text for ent in text.ents if ent.label_ in self.categories and ent.text not in speakers and ent.text not in summary_ents]
+        ori_sum = summary
+
+        summary_ents, text_ents = self.__swappable_entities(analysis)
 
         swap_dict = {}
         while summary_ents:
@@ -139,11 +303,7 @@ class NERSwap(Transformation):
             else:
                 continue
 
-        for ent1, ent2 in swap_dict.items():
-            summary = summary.replace(ent1, 'tmker')
-            summary = summary.replace(ent2, ent1)
-            summary = summary.replace('tmker', ent2)
-            break
+        summary = apply_swaps(summary, first_swaps(swap_dict, self.max_swaps))
 
         if summary == ori_sum:
             return None, 0
@@ -184,25 +344,29 @@ class PronounSwap(Transformation):
     def __init__(self, prob_swap=0.5):
         super().__init__()
 
-        self.class2pronoun_map = {
+        self.pronoun_classes = {
             "SUBJECT": ["you", "he", "she", "we", "they"],
             "OBJECT": ["me", "you", "him", "her", "us", "them"],
             "POSSESSIVE": ["my", "your", "his", "her", "its", "our", "their"],
             "REFLEXIVE": ["myself", "yourself", "himself", "itself", "outselves", "yourselves", "themselves"]
         }
 
-        self.pronoun2class_map = {pronoun: key for (key, values) in self.class2pronoun_map.items() for pronoun in values}
-        self.pronouns = {pronoun for (key, values) in self.class2pronoun_map.items() for pronoun in values}
+        self.pronoun2class_map = {pronoun: key for (key, values) in self.pronoun_classes.items() for pronoun in values}
+        self.pronouns = {pronoun for (key, values) in self.pronoun_classes.items() for pronoun in values}
+
+        self.reset()
 
-    def transform(self, example):
+    def reset(self):
+        # used replacements are removed from the map, restore it for every example
+        self.class2pronoun_map = {key: list(values) for (key, values) in self.pronoun_classes.items()}
 
-        # dialogue = example["dialogue"].replace("\n", " ")
-        # dialogue = self.spacy(dialogue, disable=["tagger", 'lemmatizer'])
-        # summary  = self.spacy(example["summary"], disable=["tagger", 'lemmatizer'])
+    def transform(self, example, analysis=None):
 
-        self.__init__()
+        analysis = self.analyse(example, analysis)
 
-        new_summary, num_swap = self.__swap_pronouns(example['summary'])
+        self.reset()
+
+        new_summary, num_swap = self.__swap_pronouns(analysis['summary_tokens'], example['summary'])
 
         if new_summary:
             new_example = { 'id': example["id"], 
@@ -213,12 +377,28 @@ class PronounSwap(Transformation):
         else:
             return None, num_swap
 
-    def __swap_pronouns(self, summary):
+    def candidates(self, example, analysis=None):
+        ''' (summary pronoun, other pronoun of the same class) pairs, up to max_swaps of them together '''
+
+        analysis = self.analyse(example, analysis)
+        summary_pronouns = sorted(set(text for text, _ in analysis['summary_tokens'] if text.lower() in self.pronouns))
+
+        return swap_combinations([(pronoun, self.__match_case(pronoun, rp_pronoun)) for pronoun in summary_pronouns
+                                  for rp_pronoun in self.pronoun_classes[self.pronoun2class_map[pronoun.lower()]]
+                                  if rp_pronoun != pronoun.lower()], self.max_swaps)
 
-        summary_new      = summary
-        summary_sp       = self.spacy(summary, disable=["tagger", 'lemmatizer'])
-        summary_pronouns = [token.text for token in summary_sp if token.text.lower() in self.pronouns]
-        summary_pronouns = list(set(summary_pronouns))
+    def apply(self, example, analysis, candidate):
+        return self.new_example(example, apply_swaps(example['summary'], dict(candidate)))
+
+    def __match_case(self, pronoun, rp_pronoun):
+        # capitalise the replacement of a capitalised pronoun
+        return rp_pronoun.capitalize() if pronoun[:1].isupper() else rp_pronoun
+
+    def __swap_pronouns(self, summary_tokens, summary):
+
+        swap_dict        = {}
+        summary_pronouns = [text for text, _ in summary_tokens if text.lower() in self.pronouns]
+        summary_pronouns = sorted(set(summary_pronouns))
 
         if len(summary_pronouns) == 0:
             return None, 0
@@ -230,18 +410,19 @@ class PronounSwap(Transformation):
             if not candidate_tokens:
                 logging.info(self.class2pronoun_map[chosen_class])
                 logging.info(candidate_tokens)
-                break
+                continue
 
             random.shuffle(candidate_tokens)
             rp_pronouns = candidate_tokens.pop()
 
-            summary_new = summary_new.replace(' ' + pronouns + ' ', 'tmker')
-            summary_new = summary_new.replace(' '+rp_pronouns+' ', ' '+pronouns+' ')
-            summary_new = summary_new.replace('tmker', ' '+rp_pronouns+' ')
+            swap_dict[pronouns] = self.__match_case(pronouns, rp_pronouns)
 
             self.class2pronoun_map[chosen_class].remove(rp_pronouns)
 
-            break
+            if len(swap_dict) == self.max_swaps:
+                break
+
+        summary_new = apply_swaps(summary, swap_dict)
 
         if summary_new == summary:
             return None, 0
@@ -258,92 +439,148 @@ class NegateSentences(Transformation):
                                    "do", "does", "did", "can", "ca", "could", "may",
                                    "might", "must", "shall", "should", "will", "would")
 
-    def transform(self, example):
+    def transform(self, example, analysis=None):
 
-        dialogue = example["dialogue"].replace("\n", " ")
-        dialogue = self.spacy(dialogue, disable=["tagger", 'lemmatizer'])
-        summary  = self.spacy(example["summary"], disable=["tagger", 'lemmatizer'])
+        analysis = self.analyse(example, analysis)
 
-        new_summary, num_edit = self.__negate_sentences(summary)
+        new_summary, num_edit = self.__negate_sentences(analysis['summary_tokens'])
 
         if new_summary:
             new_example = { 'id': example["id"], 
                             'dialogue': example["dialogue"],
-                            'summary': new_summary.text
+                            'summary': new_summary
                             }
             return new_example, num_edit
         else:
             return None, num_edit
 
-    def __negate_sentences(self, summary):
+    def candidates(self, example, analysis=None):
+        ''' (token index, negation) pairs, negation None removes an existing negation '''
+
+        token_texts = [text for text, _ in self.analyse(example, analysis)['summary_tokens']]
+
+        edits = []
+        for negated_ix, text in enumerate(token_texts):
+            if text not in self.__negatable_tokens:
+                continue
+            if negated_ix > 0 and token_texts[negated_ix - 1] in self.__negatable_tokens:
+                negated_ix = negated_ix - 1
+
+            next_text = token_texts[negated_ix + 1] if negated_ix + 1 < len(token_texts) else None
+            if next_text == "no":
+                continue
+            elif next_text in ["not", "n't"]:
+                edits.append((negated_ix, None))
+            elif token_texts[negated_ix].lower() in ["am", "may", "might", "must", "shall", "will"]:
+                edits.append((negated_ix, "not "))
+            else:
+                edits.extend([(negated_ix, "not "), (negated_ix, "n't ")])
+
+        return list(dict.fromkeys(edits))
+
+    def apply(self, example, analysis, candidate):
+        negated_ix, negation = candidate
+        return self.new_example(example, self.__negate_at(self.analyse(example, analysis)['summary_tokens'], negated_ix, negation))
+
+    def __negate_at(self, summary_tokens, negated_ix, negation):
+        # negate the token at negated_ix with negation ("not " / "n't "), or remove its negation (None)
+
+        token_texts = [text for text, _ in summary_tokens]
+        new_tokens  = [text_with_ws for _, text_with_ws in summary_tokens]
+
+        if negation is None:
+            if token_texts[negated_ix + 1].lower() == "n't":
+                if token_texts[negated_ix].lower() == "ca":
+                    new_tokens[negated_ix] = "can" if new_tokens[negated_ix].islower() else "Can"
+                new_tokens[negated_ix] = new_tokens[negated_ix] + " "
+            new_tokens.pop(negated_ix + 1)
+
+        else:
+            if negation == "n't ":
+                if token_texts[negated_ix].lower() == "can":
+                    new_tokens[negated_ix] = "ca" if new_tokens[negated_ix].islower() else "Ca"
+                else:
+                    new_tokens[negated_ix] = new_tokens[negated_ix][:-1]
+            new_tokens.insert(negated_ix + 1, negation)
+
+        # tokens keep their whitespace, so no need to re-parse
+        return "".join(new_tokens)
+
+    def __negate_sentences(self, summary_tokens):
+        # summary_tokens: (text, text_with_ws) of every token of the parsed summary
 
         used_negation = []
-        new_summary  = self.spacy(summary, disable=["tagger", 'lemmatizer'])
+        token_texts   = [text for text, _ in summary_tokens]
+        summary       = "".join(text_with_ws for _, text_with_ws in summary_tokens)
+        new_summary   = summary
 
-        candidate_tokens = [token for token in new_summary if token.text in self.__negatable_tokens and token.text]
+        candidate_tokens = [text for text in token_texts if text in self.__negatable_tokens and text]
         num_edit = len(candidate_tokens)
 
 
         while True:
             # find negatable token, return None if no candiates found
-            candidate_tokens = [token for token in new_summary if token.text in self.__negatable_tokens and token.text not in used_negation]
+            candidate_tokens = [i for i, text in enumerate(token_texts) if text in self.__negatable_tokens and text not in used_negation]
 
             if not candidate_tokens:
                 break
 
             # choose random token to negate
-            negated_token = random.choice(candidate_tokens)
-            negated_ix    = negated_token.i
-            doc_len       = len(new_summary)
+            negated_ix    = random.choice(candidate_tokens)
+            doc_len       = len(token_texts)
 
             if negated_ix > 0:
-                if new_summary[negated_ix - 1].text in self.__negatable_tokens:
-                    negated_token = new_summary[negated_ix - 1]
+                if token_texts[negated_ix - 1] in self.__negatable_tokens:
                     negated_ix    = negated_ix - 1
+            negated_token = token_texts[negated_ix]
             
             # check whether token is negative
             is_negative = False
             if (doc_len - 1) > negated_ix:
-                if new_summary[negated_ix + 1].text in ["not", "n't"]:
+                if token_texts[negated_ix + 1] in ["not", "n't"]:
                     is_negative = True
-                elif new_summary[negated_ix + 1].text == "no":
-                    used_negation.append(negated_token.text)
+                elif token_texts[negated_ix + 1] == "no":
+                    used_negation.append(negated_token)
                     continue
 
             # negate token
-            summary_tokens = [token.text_with_ws for token in new_summary]
             if is_negative:
-                if new_summary[negated_ix + 1].text.lower() == "n't":
-                    if new_summary[negated_ix].text.lower() == "ca":
-                        used_negation.append("can")
-                        used_negation.append("ca")
-                        summary_tokens[negated_ix] = "can" if summary_tokens[negated_ix].islower() else "Can"
-                    summary_tokens[negated_ix] = summary_tokens[negated_ix] + " "
-                summary_tokens.pop(negated_ix + 1)
-        
+                negation = None
+            elif token_texts[negated_ix].lower() in ["am", "may", "might", "must", "shall", "will"]:
+                negation = "not "
             else:
-                if new_summary[negated_ix].text.lower() in ["am", "may", "might", "must", "shall", "will"]:
-                    negation = "not "
-                else:
-                    negation = random.choice(["not ", "n't "])
-
-                if negation == "n't ":
-                    if new_summary[negated_ix].text.lower() == "can":
-                        used_negation.append("can")
-                        used_negation.append("ca")
-                        summary_tokens[negated_ix] = "ca" if summary_tokens[negated_ix].islower() else "Ca"
-                    else:
-                        summary_tokens[negated_ix] = summary_tokens[negated_ix][:-1]
-                summary_tokens.insert(negated_ix + 1, negation)
-
-            used_negation.append(negated_token.text)
+                negation = random.choice(["not ", "n't "])
 
-            # create new claim object
-            new_summary = self.spacy("".join(summary_tokens), disable=["tagger", 'lemmatizer'])
+            # create new claim text
+            new_summary = self.__negate_at(summary_tokens, negated_ix, negation)
 
             break
 
-        if new_summary.text == summary.text:
+        if new_summary == summary:
             return None, 0
         else:
             return new_summary, num_edit
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# error type label -> operator class
+OPERATORS = {
+    'ss_neg': SpeakerSwap,
+    'es_neg': EntitySwap,
+    'ds_neg': DateSwap,
+    'ns_neg': NumberSwap,
+    'ps_neg': PronounSwap,
+    'ng_neg': NegateSentences,
+}
+
+_OPERATOR_INSTANCES = {}
+
+
+def get_operator(label, max_swaps=1):
+    ''' operator for an error type, created once per process and reused for every sample '''
+
+    if (label, max_swaps) not in _OPERATOR_INSTANCES:
+        operator = OPERATORS[label]()
+        operator.max_swaps = max_swaps
+        _OPERATOR_INSTANCES[(label, max_swaps)] = operator
+    return _OPERATOR_INSTANCES[(label, max_swaps)]
@@ -6,236 +6,364 @@
 # Copyright (c) 2022 National University of Singapore
 # -----
 
+import os
+import sys
 import json
-import logging
+import random
+import shutil
+import hashlib
+import argparse
+import itertools
 
-from tqdm.contrib.concurrent import process_map
+from tqdm.auto import tqdm
 import augmentation_ops as ops
 
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-# load samsum test
-file_path   = './data/samsum.test.jsonl'
-raw_samples = []
-with open(file_path, 'r') as f:
-    lines = f.readlines()
-    for line in lines:
-        sample = json.loads(line)
-        raw_samples.append(sample)
-
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-# load samsum test back traslation
-file_path   = './data/samsum.test.bt.jsonl'
-bt_samples = []
-with open(file_path, 'r') as f:
-    lines = f.readlines()
-    for line in lines:
-        sample = json.loads(line)
-        bt_samples.append(sample)
-
-all_pos_sample = raw_samples + bt_samples
-
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-# perform Speaker Swap
-def _ss_corrupt(sample):
-    ''' Speaker swap '''
-    sample = sample.copy()
-    speakerswap_op = ops.SpeakerSwap()
-    sample_ss, _ = speakerswap_op.transform(sample)
-    return sample_ss, sample
-
-print("perform Speaker Swap * 5 times")
-
-ss_samples = process_map(_ss_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ss_samples2 = process_map(_ss_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ss_samples3 = process_map(_ss_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ss_samples4 = process_map(_ss_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ss_samples5 = process_map(_ss_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-
-
-ss_samples = [item[0] for item in ss_samples if item[0] is not None]
-ss_samples2 = [item[0] for item in ss_samples2 if item[0] is not None]
-ss_samples3 = [item[0] for item in ss_samples3 if item[0] is not None]
-ss_samples4 = [item[0] for item in ss_samples4 if item[0] is not None]
-ss_samples5 = [item[0] for item in ss_samples5 if item[0] is not None]
-
-for item in ss_samples2 + ss_samples3 + ss_samples4 + ss_samples5:
-    if item not in ss_samples:
-        ss_samples.append(item)
-
-
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-# perform Entity Swap
-def _es_corrupt(sample):
-    ''' Entity swap '''
-    sample = sample.copy()
-    entswap_op = ops.EntitySwap()
-    sample_es, _ = entswap_op.transform(sample)
-    return sample_es, sample
-
-print("perform Entity Swap * 5 times")
-
-es_samples = process_map(_es_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-es_samples2 = process_map(_es_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-es_samples3 = process_map(_es_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-es_samples4 = process_map(_es_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-es_samples5 = process_map(_es_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-
-es_samples = [item[0] for item in es_samples if item[0] is not None]
-es_samples2 = [item[0] for item in es_samples2 if item[0] is not None]
-es_samples3 = [item[0] for item in es_samples3 if item[0] is not None]
-es_samples4 = [item[0] for item in es_samples4 if item[0] is not None]
-es_samples5 = [item[0] for item in es_samples5 if item[0] is not None]
-
-for item in es_samples2 + es_samples3 + es_samples4 + es_samples5:
-    if item not in es_samples:
-        es_samples.append(item)
-
-
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-# perform Date Swap
-def _ds_corrupt(sample):
-    ''' Date swap '''
-    sample = sample.copy()
-    dateswap_op = ops.DateSwap()
-    sample_ds, _ = dateswap_op.transform(sample)
-    return sample_ds, sample
-
-print("perform Date Swap * 5 times")
-
-ds_samples = process_map(_ds_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ds_samples2 = process_map(_ds_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ds_samples3 = process_map(_ds_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ds_samples4 = process_map(_ds_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ds_samples5 = process_map(_ds_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-
-ds_samples = [item[0] for item in ds_samples if item[0] is not None]
-ds_samples2 = [item[0] for item in ds_samples2 if item[0] is not None]
-ds_samples3 = [item[0] for item in ds_samples3 if item[0] is not None]
-ds_samples4 = [item[0] for item in ds_samples4 if item[0] is not None]
-ds_samples5 = [item[0] for item in ds_samples5 if item[0] is not None]
-
-for item in ds_samples2 + ds_samples3 + ds_samples4 + ds_samples5:
-    if item not in ds_samples:
-        ds_samples.append(item)
-
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-# perform Number Swap
-def _ns_corrupt(sample):
-    ''' Number swap '''
-    sample = sample.copy()
-    numbswap_op = ops.NumberSwap()
-    sample_ns, _ = numbswap_op.transform(sample)
-    return sample_ns, sample
-
-print("perform Number Swap * 5 times")
-
-ns_samples = process_map(_ns_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ns_samples2 = process_map(_ns_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ns_samples3 = process_map(_ns_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ns_samples4 = process_map(_ns_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ns_samples5 = process_map(_ns_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-
-ns_samples = [item[0] for item in ns_samples if item[0] is not None]
-ns_samples2 = [item[0] for item in ns_samples2 if item[0] is not None]
-ns_samples3 = [item[0] for item in ns_samples3 if item[0] is not None]
-ns_samples4 = [item[0] for item in ns_samples4 if item[0] is not None]
-ns_samples5 = [item[0] for item in ns_samples5 if item[0] is not None]
-
-for item in ns_samples2 + ns_samples3 + ns_samples4 + ns_samples5:
-    if item not in ns_samples:
-        ns_samples.append(item)
-
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-# perform Pronoun Swap
-def _ps_corrupt(sample):
-    ''' Pronoun swap '''
-    sample = sample.copy()
-    pronswap_op = ops.PronounSwap()
-    sample_ps, _ = pronswap_op.transform(sample)
-    return sample_ps, sample
-
-print("perform Pronoun Swap * 5 times")
-
-ps_samples = process_map(_ps_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ps_samples2 = process_map(_ps_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ps_samples3 = process_map(_ps_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ps_samples4 = process_map(_ps_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ps_samples5 = process_map(_ps_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-
-ps_samples = [item[0] for item in ps_samples if item[0] is not None]
-ps_samples2 = [item[0] for item in ps_samples2 if item[0] is not None]
-ps_samples3 = [item[0] for item in ps_samples3 if item[0] is not None]
-ps_samples4 = [item[0] for item in ps_samples4 if item[0] is not None]
-ps_samples5 = [item[0] for item in ps_samples5 if item[0] is not None]
-
-for item in ps_samples2 + ps_samples3 + ps_samples4 + ps_samples5:
-    if item not in ps_samples:
-        ps_samples.append(item)
-
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-# perform Negation
-def _ng_corrupt(sample):
-    ''' Negation '''
-    sample = sample.copy()
-    negate_op = ops.NegateSentences()
-    sample_ng, _ = negate_op.transform(sample)
-    return sample_ng, sample
-
-print("perform Negation * 5 times")
-
-ng_samples = process_map(_ng_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ng_samples2 = process_map(_ng_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ng_samples3 = process_map(_ng_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ng_samples4 = process_map(_ng_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-ng_samples5 = process_map(_ng_corrupt, all_pos_sample, max_workers=10, chunksize=1)
-
-ng_samples = [item[0] for item in ng_samples if item[0] is not None]
-ng_samples2 = [item[0] for item in ng_samples2 if item[0] is not None]
-ng_samples3 = [item[0] for item in ng_samples3 if item[0] is not None]
-ng_samples4 = [item[0] for item in ng_samples4 if item[0] is not None]
-ng_samples5 = [item[0] for item in ng_samples5 if item[0] is not None]
-
-for item in ng_samples2 + ng_samples3 + ng_samples4 + ng_samples5:
-    if item not in ng_samples:
-        ng_samples.append(item)
-
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-
-# all_pos_sample
-all_samples = []
-for sample in all_pos_sample:
-    sample['label'] = 'pos'
-    all_samples.append(sample)
-    
-for sample in ss_samples:
-    sample['label'] = 'ss_neg'
-    all_samples.append(sample)
-
-
-for sample in es_samples:
-    sample['label'] = 'es_neg'
-    all_samples.append(sample)
-
-
-for sample in ds_samples:
-    sample['label'] = 'ds_neg'
-    all_samples.append(sample)
-
-
-for sample in ns_samples:
-    sample['label'] = 'ns_neg'
-    all_samples.append(sample)
+# the columnar sample format is shared with the scorer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fac_gen_src'))
+from columnar import write_columnar
+
+# error type label -> name used in the progress messages
+OPERATOR_NAMES = {
+    'ss_neg': 'Speaker Swap',
+    'es_neg': 'Entity Swap',
+    'ds_neg': 'Date Swap',
+    'ns_neg': 'Number Swap',
+    'ps_neg': 'Pronoun Swap',
+    'ng_neg': 'Negation',
+}
+
+
+def parse_args():
+    '''
+        config arguments for generating the FacEval samples
+    '''
+    parser = argparse.ArgumentParser(description="Generate factually corrupted summaries for FacEval")
+
+    parser.add_argument("--samsum_file", type=str, default='./data/samsum.test.jsonl', help="SAMSum test set (jsonl).")
+    parser.add_argument("--bt_file", type=str, default='./data/samsum.test.bt.jsonl', help="Back-translated SAMSum test set (jsonl).")
+    parser.add_argument("--output_file", type=str, default='./new_generated_samples.jsonl', help="Where to write the generated samples.")
+    parser.add_argument("--num_passes", type=int, default=5, help="Number of times each operator is applied to every sample.")
+    parser.add_argument(
+        "--num_negatives",
+        type=int,
+        default=None,
+        help="Target number of distinct negatives per sample and error type, sampled without replacement "
+        "from the candidate edits of each operator. If not set, every operator runs `num_passes` times.",
+    )
+    parser.add_argument(
+        "--max_swaps",
+        type=int,
+        default=1,
+        help="Number of speaker / entity / pronoun swaps applied together in one corrupted summary "
+        "(with `num_negatives`, every sampled candidate edit combines that many swaps).",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=2000,
+        help="Number of parsed samples held in memory and corrupted together.",
+    )
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=str,
+        default='./generation_checkpoints',
+        help="Where finished (operator, pass, shard) units are stored, an interrupted run resumes from them.",
+    )
+    parser.add_argument(
+        "--arrow_dir",
+        type=str,
+        default=None,
+        help="Also write the samples as a columnar (Arrow) sample set to this directory, for fac_gen_src/main.py --load_file.",
+    )
+    parser.add_argument("--keep_checkpoints", action="store_true", help="Keep the checkpoint dir after the final merge.")
+    parser.add_argument("--spacy_batch_size", type=int, default=64, help="Batch size of nlp.pipe.")
+    parser.add_argument("--spacy_n_process", type=int, default=1, help="Number of processes used by nlp.pipe.")
+    parser.add_argument("--seed", type=int, default=None, help="A seed for reproducible generation.")
+
+    return parser.parse_args()
+
+
+def iter_jsonl(file_path):
+    ''' stream samples from a jsonl file '''
+
+    with open(file_path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_jsonl(f, samples, label):
+    ''' append samples with their label to an open jsonl file '''
+
+    for sample in samples:
+        sample['label'] = label
+        f.write(json.dumps(sample) + '\n')
+
+
+def sample_hash(sample):
+    ''' canonical hash of a generated sample, (id, summary) '''
+
+    return hashlib.sha1(json.dumps([sample['id'], sample['summary']]).encode('utf-8')).digest()
+
+
+class Deduplicator():
+    # Keep the first occurrence of every (id, summary) per error type
+    def __init__(self, labels, num_passes):
+        self.seen        = {label: set() for label in labels}
+        self.pass_counts = {label: [0] * num_passes for label in labels}
+
+    def add(self, label, pass_index, sample):
+        ''' True if the sample is new for this error type '''
+
+        key = sample_hash(sample)
+        if key in self.seen[label]:
+            return False
+
+        self.seen[label].add(key)
+        self.pass_counts[label][pass_index] += 1
+        return True
+
+    def report(self, label):
+        ''' number of distinct samples, and how many each pass contributed '''
+
+        return "{} samples, new per pass: {}".format(
+            len(self.seen[label]), ", ".join(str(count) for count in self.pass_counts[label]))
+
+
+def sample_negatives(operator, label, chunk, num_negatives, dedup):
+    ''' up to num_negatives distinct negatives per sample, drawn without replacement from the
+        candidate edits of the operator. Samples without any candidate are skipped right away.
+    '''
+
+    new_samples, num_skipped = [], 0
+    for sample, analysis in chunk:
+        candidates = operator.candidates(sample, analysis)
+        if not candidates:
+            num_skipped += 1
+            continue
+
+        num_found = 0
+        for candidate in random.sample(candidates, len(candidates)):
+            new_sample = operator.apply(sample, analysis, candidate)
+            if new_sample is not None and dedup.add(label, 0, new_sample):
+                new_samples.append(new_sample)
+                num_found += 1
+                if num_found == num_negatives:
+                    break
+
+    return new_samples, num_skipped
+
+
+class Checkpoints():
+    # Finished units of a generation run, one jsonl file per (operator, pass, shard)
+    def __init__(self, checkpoint_dir, config):
+        self.checkpoint_dir = checkpoint_dir
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        config_file = os.path.join(checkpoint_dir, 'config.json')
+        if not os.path.exists(config_file) and os.listdir(checkpoint_dir):
+            raise ValueError("{} is not empty and holds no generation run, "
+                             "use another --checkpoint_dir".format(checkpoint_dir))
+        if os.path.exists(config_file):
+            with open(config_file, 'r') as f:
+                if json.load(f) != config:
+                    raise ValueError("{} holds units of a run with another configuration, "
+                                     "remove it or use another --checkpoint_dir".format(checkpoint_dir))
+        else:
+            self.write_atomic(config_file, json.dumps(config, indent=4))
 
+    def unit_path(self, label, pass_index, shard):
+        if label == 'pos':
+            return os.path.join(self.checkpoint_dir, label, 'shard{}.jsonl'.format(shard))
+        return os.path.join(self.checkpoint_dir, label, 'pass{}_shard{}.jsonl'.format(pass_index, shard))
 
-for sample in ps_samples:
-    sample['label'] = 'ps_neg'
-    all_samples.append(sample)
-
-
-for sample in ng_samples:
-    sample['label'] = 'ng_neg'
-    all_samples.append(sample)
-
+    def done(self, label, pass_index, shard):
+        return os.path.exists(self.unit_path(label, pass_index, shard))
 
-with open('./new_generated_samples.jsonl', 'w') as f:
-    json.dump(all_samples, f, indent=4)
\ No newline at end of file
+    def load(self, label, pass_index, shard):
+        ''' samples and stats of a finished unit '''
+
+        path = self.unit_path(label, pass_index, shard)
+        with open(path[:-len('.jsonl')] + '.stats.json', 'r') as f:
+            stats = json.load(f)
+        return list(iter_jsonl(path)), stats
+
+    def save(self, label, pass_index, shard, samples, stats):
+        ''' store a unit, the jsonl file only appears once it is complete '''
+
+        path = self.unit_path(label, pass_index, shard)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.write_atomic(path[:-len('.jsonl')] + '.stats.json', json.dumps(stats))
+
+        with open(path + '.tmp', 'w') as f:
+            write_jsonl(f, samples, label)
+        os.replace(path + '.tmp', path)
+
+    def remove(self, units):
+        ''' delete the unit files and the config, directories are only removed once they are empty '''
+
+        for label, pass_index, shard in units:
+            path = self.unit_path(label, pass_index, shard)
+            for unit_file in (path, path[:-len('.jsonl')] + '.stats.json'):
+                if os.path.exists(unit_file):
+                    os.remove(unit_file)
+        os.remove(os.path.join(self.checkpoint_dir, 'config.json'))
+
+        for directory in sorted(set(os.path.dirname(self.unit_path(*unit)) for unit in units)) + [self.checkpoint_dir]:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass
+
+    def write_atomic(self, path, text):
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(path + '.tmp', path)
+
+
+def run_config(args):
+    ''' everything that changes the generated samples, a resumed run has to match it '''
+
+    return {
+        'inputs'       : [[os.path.abspath(path), os.path.getsize(path), os.stat(path).st_mtime_ns]
+                          for path in (args.samsum_file, args.bt_file)],
+        'num_passes'   : args.num_passes,
+        'num_negatives': args.num_negatives,
+        'max_swaps'    : args.max_swaps,
+        'chunk_size'   : args.chunk_size,
+        'seed'         : args.seed,
+    }
+
+
+def iter_chunks(samples, chunk_size):
+    ''' consecutive lists of chunk_size samples '''
+
+    samples = iter(samples)
+    while True:
+        chunk = list(itertools.islice(samples, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def run_unit(operator, label, pass_index, chunk, args, dedup):
+    ''' new distinct negatives of one (operator, pass, shard) unit, and the number of skipped samples '''
+
+    if args.num_negatives is not None:
+        return sample_negatives(operator, label, chunk, args.num_negatives, dedup)
+
+    new_samples = []
+    for sample, analysis in chunk:
+        new_sample, _ = operator.transform(sample.copy(), analysis)
+        if new_sample is not None and dedup.add(label, pass_index, new_sample):
+            new_samples.append(new_sample)
+
+    return new_samples, 0
+
+
+def generate_negatives(all_pos_sample, args, checkpoints):
+    ''' corrupt every positive sample with every operator, either `num_passes` blind passes or
+        up to `num_negatives` sampled candidate edits per sample
+
+        The samples are split into shards of chunk_size, and every (operator, pass, shard) unit
+        is checkpointed as soon as it is done. Finished units are loaded instead of recomputed
+        (shards that are entirely done are not even parsed) and refill the dedup state, so a
+        resumed run ends up with the same samples as an uninterrupted one. Returns the units
+        in output order.
+    '''
+
+    num_passes = 1 if args.num_negatives is not None else args.num_passes
+    dedup      = Deduplicator(ops.OPERATORS, num_passes)
+    unit_keys  = [('pos', 0)] + [(label, pass_index) for label in ops.OPERATORS for pass_index in range(num_passes)]
+    skipped    = {label: 0 for label, _ in unit_keys}
+
+    shard_done = {}
+    def is_shard_done(shard):
+        if shard not in shard_done:
+            shard_done[shard] = all(checkpoints.done(label, pass_index, shard) for label, pass_index in unit_keys)
+        return shard_done[shard]
+
+    # spaCy only parses the shards with unfinished units, still in one nlp.pipe stream
+    chunks, chunks_for_pipe = itertools.tee(enumerate(iter_chunks(all_pos_sample, args.chunk_size)))
+    to_parse = (sample for shard, chunk in chunks_for_pipe if not is_shard_done(shard) for sample in chunk)
+    analyses = ops.iter_analyses(to_parse, batch_size=args.spacy_batch_size, n_process=args.spacy_n_process)
+
+    units    = []
+    progress = tqdm(desc="corrupt samples")
+    for shard, chunk in chunks:
+        if is_shard_done(shard):
+            chunk = [(sample, None) for sample in chunk]
+        else:
+            chunk = list(zip(chunk, itertools.islice(analyses, len(chunk))))
+
+        for label, pass_index in unit_keys:
+            units.append((label, pass_index, shard))
+
+            if checkpoints.done(label, pass_index, shard):
+                new_samples, stats = checkpoints.load(label, pass_index, shard)
+                for new_sample in new_samples:
+                    if label != 'pos':
+                        dedup.add(label, pass_index, new_sample)
+                skipped[label] += stats['num_skipped']
+                continue
+
+            if label == 'pos':
+                new_samples, num_skipped = [sample.copy() for sample, _ in chunk], 0
+            else:
+                if args.seed is not None:
+                    random.seed("{}-{}-{}-{}".format(args.seed, label, pass_index, shard))
+                new_samples, num_skipped = run_unit(ops.get_operator(label, args.max_swaps), label, pass_index, chunk, args, dedup)
+
+            checkpoints.save(label, pass_index, shard, new_samples, {'num_skipped': num_skipped})
+            skipped[label] += num_skipped
+
+        progress.update(len(chunk))
+    progress.close()
+
+    for label in ops.OPERATORS:
+        if args.num_negatives is not None:
+            print("sample {} up to {} per sample: {} samples, {} samples without candidates".format(
+                OPERATOR_NAMES[label], args.num_negatives, len(dedup.seen[label]), skipped[label]))
+        else:
+            print("perform {} * {} times: {}".format(OPERATOR_NAMES[label], args.num_passes, dedup.report(label)))
+
+    return units
+
+
+def merge_units(checkpoints, units, output_file):
+    ''' concatenate the unit files into the final jsonl (shard by shard, passes in order) '''
+
+    with open(output_file + '.tmp', 'wb') as f:
+        for label, pass_index, shard in units:
+            with open(checkpoints.unit_path(label, pass_index, shard), 'rb') as unit_file:
+                shutil.copyfileobj(unit_file, f)
+    os.replace(output_file + '.tmp', output_file)
+
+
+def main():
+    args = parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+    # stream samsum test and samsum test back traslation
+    all_pos_sample = itertools.chain(iter_jsonl(args.samsum_file), iter_jsonl(args.bt_file))
+
+    # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+    # perform Speaker / Entity / Date / Number / Pronoun Swap and Negation, checkpointed per unit
+    checkpoints = Checkpoints(args.checkpoint_dir, run_config(args))
+    units       = generate_negatives(all_pos_sample, args, checkpoints)
+
+    # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+    # merge all units, one jsonl line per sample
+    merge_units(checkpoints, units, args.output_file)
+    if args.arrow_dir is not None:
+        write_columnar(iter_jsonl(args.output_file), args.arrow_dir)
+    if not args.keep_checkpoints:
+        checkpoints.remove(units)
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+###
+# Author: Bin Wang
+# -----
+# Copyright (c) 2022 National University of Singapore
+# -----
+
+
+import random
+
+import torch
+from torch.utils.data import DataLoader
+from transformers import BartConfig, BartForConditionalGeneration
+
+from scorer import compute_sample_probs, compute_grouped_sample_probs
+
+
+PAD_TOKEN_ID = 1
+
+
+def tiny_bart():
+    ''' randomly initialised BART, small enough to score on CPU in a test '''
+
+    torch.manual_seed(0)
+    config = BartConfig(vocab_size=64, d_model=16, encoder_layers=1, decoder_layers=1, encoder_attention_heads=2,
+                        decoder_attention_heads=2, encoder_ffn_dim=32, decoder_ffn_dim=32, max_position_embeddings=64,
+                        pad_token_id=PAD_TOKEN_ID, bos_token_id=0, eos_token_id=2, decoder_start_token_id=2)
+    return BartForConditionalGeneration(config).eval()
+
+
+def candidate_rows(num_dialogues=5, seed=0):
+    ''' (input_ids, labels, sample_ids): a few candidate summaries of different lengths per dialogue '''
+
+    rng = random.Random(seed)
+    input_ids, labels, sample_ids = [], [], []
+    for dialogue_id in range(num_dialogues):
+        dialogue = [rng.randrange(3, 64) for _ in range(rng.randint(4, 20))]
+        for _ in range(rng.randint(1, 4)):
+            input_ids.append(dialogue)
+            labels.append([rng.randrange(3, 64) for _ in range(rng.randint(2, 12))])
+            sample_ids.append(str(dialogue_id))
+
+    return input_ids, labels, sample_ids
+
+
+def test_grouped_matches_batch_size_one():
+    model = tiny_bart()
+    input_ids, labels, sample_ids = candidate_rows()
+
+    # one sample per batch: no padding at all
+    dataset    = [{'input_ids': torch.tensor([source]), 'attention_mask': torch.ones(1, len(source), dtype=torch.long),
+                   'labels': torch.tensor([target]), 'row_index': torch.tensor([index])}
+                  for index, (source, target) in enumerate(zip(input_ids, labels))]
+    dataloader = DataLoader(dataset, batch_size=None)
+    reference  = compute_sample_probs(model, dataloader)
+
+    # several padded dialogues per encoder batch, candidates decoded against the shared encoder output
+    grouped = compute_grouped_sample_probs(model, input_ids, labels, sample_ids, batch_size=3, pad_token_id=PAD_TOKEN_ID,
+                                           device=torch.device('cpu'), progress=False)
+
+    assert len(grouped) == len(reference)
+    assert max(abs(a - b) for a, b in zip(grouped, reference)) <= 2e-6
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+###
+# Author: Bin Wang
+# -----
+# Copyright (c) 2022 National University of Singapore
+# -----
+
+
+import random
+
+from metrics import aggregate_scores
+from incremental import Manifest, manifest_key, incremental_scores
+
+
+NEG_MARKERS = ['_neg', 'ss_neg', 'ps_neg']
+
+
+def sample_set(num_dialogues=12, seed=0):
+    ''' {(dialogue id, label, summary): log-prob} with one positive and a few negatives per dialogue '''
+
+    rng     = random.Random(seed)
+    samples = {}
+    for dialogue_id in range(num_dialogues):
+        samples[(str(dialogue_id), 'pos', 'summary {}'.format(dialogue_id))] = round(rng.uniform(-3, -1), 1)
+        for label in ('ss_neg', 'ps_neg'):
+            for index in range(rng.randint(0, 3)):
+                samples[(str(dialogue_id), label, '{} {} {}'.format(label, dialogue_id, index))] = round(rng.uniform(-3, -1), 1)
+
+    return samples
+
+
+def scores(samples, manifest):
+    ''' (incremental results, full aggregate_scores results, number of recomputed per-dialogue results) '''
+
+    rows = {split: [(key, prob) for key, prob in samples.items() if (key[1] == 'pos') == (split == 'pos')]
+            for split in ('pos', 'neg')}
+    columns = {split: {'ids'   : [key[0] for key, _ in rows[split]],
+                       'labels': [key[1] for key, _ in rows[split]],
+                       'keys'  : [manifest_key('namespace', 'dialogue ' + key[0], key[2]) for key, _ in rows[split]],
+                       'probs' : [prob for _, prob in rows[split]]}
+               for split in rows}
+
+    results, dialogues, num_recomputed = incremental_scores(
+        manifest, columns['pos']['ids'], columns['pos']['keys'], columns['pos']['probs'], columns['neg']['ids'],
+        columns['neg']['keys'], columns['neg']['labels'], columns['neg']['probs'], NEG_MARKERS, num_bootstrap=100, seed=1)
+    manifest.update(columns['pos']['keys'] + columns['neg']['keys'], columns['pos']['probs'] + columns['neg']['probs'],
+                    dialogues, 'strict')
+    manifest.save()
+
+    full = aggregate_scores(columns['pos']['ids'], columns['pos']['probs'], columns['neg']['ids'], columns['neg']['labels'],
+                            columns['neg']['probs'], NEG_MARKERS, num_bootstrap=100, seed=1)
+
+    return results, full, num_recomputed
+
+
+def test_incremental_matches_full_run(tmp_path):
+    manifest_file = str(tmp_path / 'manifest.json')
+    samples       = sample_set()
+
+    results, full, num_recomputed = scores(samples, Manifest(manifest_file))
+    assert results == full
+    assert num_recomputed == sum(result['num_dialogues'] for result in full.values())
+
+    # an unchanged sample set recomputes nothing
+    results, full, num_recomputed = scores(samples, Manifest(manifest_file))
+    assert results == full
+    assert num_recomputed == 0
+
+    # edit a negative of dialogue 0, drop the negatives of dialogue 1 and add dialogue 99
+    edited = {key: prob for key, prob in samples.items() if not (key[0] == '1' and key[1] != 'pos')}
+    edited[('0', 'ss_neg', 'edited')] = -0.5
+    edited[('99', 'pos', 'summary 99')] = -2.0
+    edited[('99', 'ps_neg', 'ps_neg 99')] = -1.0
+
+    results, full, num_recomputed = scores(edited, Manifest(manifest_file))
+    assert results == full
+    # dialogues 0 and 99 under '_neg', 0 under 'ss_neg' and 99 under 'ps_neg'
+    assert num_recomputed == 4